@@ -1,14 +1,16 @@
 import streamlit as st
 import pandas as pd
-import requests
-import io
-from io import StringIO
-import plotly.express as px
-from azure.storage.blob import BlobServiceClient
 import os 
 import dotenv
 from dotenv import load_dotenv
 
+from helpers.datahelpers import AGGREGATIONS, aggregate, filtered_summary, unique_values
+from helpers.datasethelpers import fetch_shared_flows, get_dataset_store
+from helpers.exporthelpers import EXPORT_FORMATS, existing_archive, existing_export, export_archive, export_flow
+from helpers.mappinghelpers import build_queries, get_mapping_etag, load_mapping_catalogue
+from helpers.metrichelpers import finish_run, prometheus_text, span, start_run
+from helpers.plothelpers import cached_figure
+
 
 # extract the MAPPING FILE - ONLY ONCE
 
@@ -18,26 +20,26 @@ connection_string =  os.environ["CONNECTION_STRING_BLOB"]
 container_name =os.environ["CONTAINER_NAME"]
 blob_name = os.environ["MAPPING_FILE_NAME"]
 
-@st.cache_data
-def load_mapping_csv(connection_string, container_name, blob_name):
+# How often the mapping blob's ETag is checked for a new version of the catalogue
+MAPPING_REFRESH_SECONDS = 300
+
+@st.cache_data(ttl=MAPPING_REFRESH_SECONDS, show_spinner=False)
+def mapping_version(connection_string, container_name, blob_name):
+    """
+    Returns the ETag of the mapping blob. Cached for MAPPING_REFRESH_SECONDS,
+    so a catalogue update is picked up without restarting the app. While the
+    blob service cannot be reached, the last known version is used.
+    """
+    return get_mapping_etag(connection_string, container_name, blob_name, fallback=True)
+
+@st.cache_resource(max_entries=2, show_spinner=False)
+def load_mapping(connection_string, container_name, blob_name, etag):
     """
-    Downloads the CSV from Azure Blob Storage and returns a DataFrame.
-    This function is cached, so subsequent calls with the same parameters will
-    return the cached DataFrame instead of re-downloading the file.
+    Returns the indexed mapping catalogue for one version of the mapping blob.
+    The catalogue is shared by all sessions of this worker; other workers
+    start from its Parquet snapshot instead of re-parsing the CSV.
     """
-    # Create the BlobServiceClient to interact with the Blob service
-    blob_service_client = BlobServiceClient.from_connection_string(connection_string)
-    
-    # Get a client for the specific container and blob
-    container_client = blob_service_client.get_container_client(container_name)
-    blob_client = container_client.get_blob_client(blob_name)
-    
-    # Download the blob's contents as text
-    download_stream = blob_client.download_blob()
-    csv_text = download_stream.content_as_text()
-    
-    # Load the CSV text into a DataFrame and return it
-    return pd.read_csv(io.StringIO(csv_text))
+    return load_mapping_catalogue(connection_string, container_name, blob_name, etag)
 #########################
 
 
@@ -45,324 +47,336 @@ st.set_page_config(page_title="UNICEF SDMX API Data Explorer", layout="wide")
 
 st.title("UNICEF SDMX API Data Explorer")
 
-# Load the mapping CSV file (now using the classified version)
-# Expected columns include: 'dataflow_name', 'agency', 'dataflow_id', 'geography', 'geography_id',
-# 'indicator', 'indicator_id', 'category', and (optionally) 'Country'
-try:
-    df_mapping = load_mapping_csv(connection_string, container_name, blob_name)
-except Exception as e:
-    st.error("Error loading CSV file: " + str(e))
-    st.stop()
-
-##############################################
-# Step 1: Geography Selection (using Country column)
-##############################################
-# If you want to use the "Country" column instead of "geography", you can first check if it exists.
-all_geographies = sorted(df_mapping["country"].dropna().unique(), key=lambda x: str(x))
-
-
-selected_geographies = st.multiselect("Select country", all_geographies)
-if not selected_geographies:
-    st.info("Please select at least one country.")
-    st.stop()
+# Timings and counters of this run, shown in the sidebar on demand
+run_trace = start_run()
+show_performance = st.sidebar.checkbox("Show performance breakdown", key="show_performance")
+# Filled at the end of every run, including the runs that end early
+performance_panel = st.sidebar.container()
 
-# Filter the mapping by the selected geography(ies)
-df_geo = df_mapping[df_mapping["country"].isin(selected_geographies)]
 
-##############################################
-# Step 1.5: National vs. Subnational Filter
-##############################################
-# Assuming your mapping dataframe has a column "national" with values 0 (subnational) or 1 (national)
-if "national" in df_geo.columns:
-    national_option = st.radio("Select data level", options=["National", "Subnational"], index=0)
-    # Convert "National" to 1 and "Subnational" to 0.
-    level = 1 if national_option == "National" else 0
-    df_geo = df_geo[df_geo["national"] == level]
-
-# If subnational is selected, enforce that exactly one country is chosen.
-if national_option == "Subnational" and len(selected_geographies) != 1:
-    st.error("For subnational data, please select exactly one country.")
-    st.stop()
-
-if national_option == "Subnational" and df_geo.empty:
-    st.error("No subnational data available for the selected country")
-    st.stop()
-
-##############################################
-# Step 1.75: Category Filter
-##############################################
-if "category" in df_geo.columns:
-    available_categories = sorted(df_geo["category"].dropna().unique(), key=lambda x: str(x))
-    selected_categories = st.multiselect("Select Category", available_categories)
-    if selected_categories:
-        df_geo = df_geo[df_geo["category"].isin(selected_categories)]
-
-##############################################
-# Step 2: Indicator Selection
-##############################################
-available_indicators = sorted(df_geo["indicator"].dropna().unique(), key=lambda x: str(x))
-selected_indicators = st.multiselect("Select Indicator(s)", available_indicators, key="indicator_multiselect")
-if not selected_indicators:
-    st.info("Please select at least one indicator.")
-    st.stop()
-
-# If subnational is selected, enforce that exactly one indicator is chosen.
-if national_option == "Subnational" and len(selected_indicators) != 1:
-    st.error("For subnational data, please select exactly one indicator.")
-    st.stop()
-
-# Enforce limitation: either multiple geographies with one indicator or one geography with multiple indicators.
-if len(selected_geographies) > 1 and len(selected_indicators) > 1:
-    st.error("Please select either multiple countries with one indicator, or one country with multiple indicators.")
-    st.stop()
+class PageEnd(Exception):
+    """
+    Ends the page early, like st.stop(), while still running the finally
+    block below: the metrics of the run are exported and the performance
+    panel is rendered for these runs too.
+    """
 
-##############################################
-# Step 3: Determine Candidate Data Flows
-##############################################
-df_candidates = df_geo[df_geo["indicator"].isin(selected_indicators)]
-candidate_flows = sorted(df_candidates["dataflow_name"].dropna().unique(), key=lambda x: str(x))
-if not candidate_flows:
-    st.error("No data flows found for the selected geography, category, and indicator(s).")
-    st.stop()
-
-if len(candidate_flows) == 1:
-    chosen_dataflows = candidate_flows
-    st.info(f"Automatically selected dataflow: {candidate_flows[0]}")
-else:
-    chosen_dataflows = st.multiselect("Multiple data flows found. Please select the data flows to query", candidate_flows, default=candidate_flows)
-    if not chosen_dataflows:
-        st.error("Please select at least one data flow to query.")
-        st.stop()
 
-##############################################
-# Step 4: Fetch Data for Each Selected Dataflow
-##############################################
+def end_page():
+    raise PageEnd()
 
 
-if st.button("Fetch Data"):
+def remember_indicators():
+    """
+    Keeps the chosen indicators outside the multiselect: Streamlit resets a
+    multiselect whenever its options change, which every search edit does.
+    """
+    st.session_state["chosen_indicators"] = st.session_state["indicator_multiselect"]
 
-    st.subheader("Fetching Data")
-    with st.expander("**Details of fetching data**", expanded=False):
 
-        flow_data = {}
-        for flow in chosen_dataflows:
-            df_flow = df_candidates[df_candidates["dataflow_name"] == flow]
-            if df_flow.empty:
+try:
+    # Load the mapping CSV file (now using the classified version)
+    # Expected columns include: 'dataflow_name', 'agency', 'dataflow_id', 'geography', 'geography_id',
+    # 'indicator', 'indicator_id', 'category', and (optionally) 'Country'
+    try:
+        with span("mapping"):
+            mapping = load_mapping(connection_string, container_name, blob_name, mapping_version(connection_string, container_name, blob_name))
+    except Exception as e:
+        st.error("Error loading CSV file: " + str(e))
+        end_page()
+
+    ##############################################
+    # Step 1: Geography Selection (using Country column)
+    ##############################################
+    # If you want to use the "Country" column instead of "geography", you can first check if it exists.
+    all_geographies = mapping.countries
+
+
+    selected_geographies = st.multiselect("Select country", all_geographies)
+    if not selected_geographies:
+        st.info("Please select at least one country.")
+        end_page()
+
+    ##############################################
+    # Step 1.5: National vs. Subnational Filter
+    ##############################################
+    # Assuming your mapping dataframe has a column "national" with values 0 (subnational) or 1 (national)
+    national_option = "National"
+    level = None
+    if mapping.has_national:
+        national_option = st.radio("Select data level", options=["National", "Subnational"], index=0)
+        # Convert "National" to 1 and "Subnational" to 0.
+        level = 1 if national_option == "National" else 0
+
+    # If subnational is selected, enforce that exactly one country is chosen.
+    if national_option == "Subnational" and len(selected_geographies) != 1:
+        st.error("For subnational data, please select exactly one country.")
+        end_page()
+
+    if national_option == "Subnational" and not mapping.has_rows(selected_geographies, level):
+        st.error("No subnational data available for the selected country")
+        end_page()
+
+    ##############################################
+    # Step 1.75: Category Filter
+    ##############################################
+    selected_categories = []
+    if mapping.has_category:
+        available_categories = mapping.categories(selected_geographies, level)
+        selected_categories = st.multiselect("Select Category", available_categories)
+
+    ##############################################
+    # Step 2: Indicator Selection
+    ##############################################
+    available_indicators = mapping.indicators(selected_geographies, level, selected_categories)
+
+    # The search ranks the indicators of the whole catalogue; the list keeps the
+    # best matches available for the selection above
+    indicator_query = st.text_input("Search indicators by name, ID, category or dataflow", key="indicator_search")
+    available = set(available_indicators)
+    # Indicators already chosen stay selected whatever the search, while the selection above still offers them
+    chosen = [i for i in st.session_state.get("chosen_indicators", []) if i in available]
+    indicator_options = available_indicators
+    if indicator_query:
+        with span("indicator_search"):
+            matches = mapping.search_indicators(indicator_query)
+        ranked = [i for i in matches if i in available]
+        other_matches = [i for i in matches if i not in available]
+        ranked_set = set(ranked)
+        indicator_options = ranked + [i for i in chosen if i not in ranked_set]
+        st.caption(f"{len(ranked)} matching indicators for this selection, best matches first.")
+        if other_matches:
+            other_categories = sorted({str(c) for i in other_matches for c in mapping.indicator_categories(i)} - set(selected_categories))
+            note = f"{len(other_matches)} more matching indicators are not available for the selected countries or categories"
+            if other_categories:
+                note += f" (found in: {', '.join(other_categories[:5])}{', ...' if len(other_categories) > 5 else ''})"
+            st.caption(note + ".")
+
+    selected_indicators = st.multiselect(
+        "Select Indicator(s)", indicator_options, default=chosen, key="indicator_multiselect", on_change=remember_indicators
+    )
+    if not selected_indicators:
+        st.info("Please select at least one indicator.")
+        end_page()
+
+    # If subnational is selected, enforce that exactly one indicator is chosen.
+    if national_option == "Subnational" and len(selected_indicators) != 1:
+        st.error("For subnational data, please select exactly one indicator.")
+        end_page()
+
+    # Enforce limitation: either multiple geographies with one indicator or one geography with multiple indicators.
+    if len(selected_geographies) > 1 and len(selected_indicators) > 1:
+        st.error("Please select either multiple countries with one indicator, or one country with multiple indicators.")
+        end_page()
+
+    ##############################################
+    # Step 3: Determine Candidate Data Flows
+    ##############################################
+    df_candidates = mapping.rows(selected_geographies, level, selected_categories, selected_indicators)
+    candidate_flows = sorted(df_candidates["dataflow_name"].dropna().unique(), key=lambda x: str(x))
+    if not candidate_flows:
+        st.error("No data flows found for the selected geography, category, and indicator(s).")
+        end_page()
+
+    if len(candidate_flows) == 1:
+        chosen_dataflows = candidate_flows
+        st.info(f"Automatically selected dataflow: {candidate_flows[0]}")
+    else:
+        chosen_dataflows = st.multiselect("Multiple data flows found. Please select the data flows to query", candidate_flows, default=candidate_flows)
+        if not chosen_dataflows:
+            st.error("Please select at least one data flow to query.")
+            end_page()
+
+    ##############################################
+    # Step 4: Fetch Data for Each Selected Dataflow
+    ##############################################
+
+
+    if st.button("Fetch Data"):
+
+        st.subheader("Fetching Data")
+        with st.expander("**Details of fetching data**", expanded=False):
+
+            # Build the query of every flow first, then fetch all flows in parallel
+            # (the key itself is built from the dataflow's data structure when the flow is fetched)
+            jobs, missing_flows = build_queries(df_candidates, chosen_dataflows, selected_geographies, selected_indicators, national=national_option == "National")
+            for flow in missing_flows:
                 st.error(f"No mapping data found for dataflow: {flow}")
-                continue
-            first_row = df_flow.iloc[0]
-            agency = first_row["agency"]
-            dataflow_id = first_row["dataflow_id"]
-            # Use the appropriate column based on what was used above
-
-
-            if national_option == "National":
-                geo_ids = df_flow[df_flow["country"].isin(selected_geographies)]["geography_id"].unique().tolist()
-                geos = df_flow[df_flow["country"].isin(selected_geographies)]["geography"].unique().tolist()
-            
-            if national_option == "Subnational":
-                geo_ids = ""
-                geos = df_flow[df_flow["country"].isin(selected_geographies)]["geography"].unique().tolist()
-
-            indicator_ids = df_flow[df_flow["indicator"].isin(selected_indicators)]["indicator_id"].unique().tolist()
-            geography_id_str = "+".join(geo_ids)
-            geography_str = "+".join(geos)
-            indicator_id_str = "+".join(indicator_ids)
-            
-            api_url = (
-                f"https://sdmx.data.unicef.org/ws/public/sdmxapi/rest/data/"
-                f"{agency},{dataflow_id},1.0/{geography_id_str}.{indicator_id_str}"
-                "?format=csv&labels=both"
-            )
-
-            api_url_bis = (
-                f"https://sdmx.data.unicef.org/ws/public/sdmxapi/rest/data/"
-                f"{agency},{dataflow_id},1.0/.{geography_id_str}..{indicator_id_str}"
-                "?format=csv&labels=both"
-            )
-
-            api_url_ter = (
-                f"https://sdmx.data.unicef.org/ws/public/sdmxapi/rest/data/"
-                f"{agency},{dataflow_id},1.0/{indicator_id_str}..{geography_str}."
-                "?format=csv&labels=both"
-            )
-
-            
-            st.write(f"Fetching data for dataflow: {flow}")
-            st.code(api_url)
-            response = requests.get(api_url)
-
-            if response.status_code == 200:
-                try:
-                    df_data_flow = pd.read_csv(StringIO(response.text))
-                    # Convert OBS_VALUE to float, if present.
-                    if "OBS_VALUE" in df_data_flow.columns:
-                        df_data_flow["OBS_VALUE"] = pd.to_numeric(df_data_flow["OBS_VALUE"], errors="coerce")
-                    df_data_flow["dataflow"] = flow
-                    flow_data[flow] = df_data_flow
-                except Exception as e:
-                    st.error(f"Error reading CSV data for {flow}: {e}")
+
+            # Results arrive as each flow finishes, so the page fills in progressively.
+            # The frames live in the process-wide dataset store: the session only
+            # keeps a handle per flow, and identical queries of other sessions share them.
+            previous_handles = st.session_state.get("flow_handles", {})
+            flow_handles = {}
+            with span("fetch", flows=len(jobs)):
+                for result in fetch_shared_flows(jobs):
+                    for kind, text in result["messages"]:
+                        if kind == "code":
+                            st.code(text)
+                        elif kind == "error":
+                            st.error(text)
+                        else:
+                            st.write(text)
+
+                    if result["handle"] is not None:
+                        flow_handles[result["flow"]] = result["handle"]
+                        # Keep the flows in the order they were selected, whatever order they finish in
+                        st.session_state["flow_handles"] = {f: flow_handles[f] for f in jobs if f in flow_handles}
+            for handle in previous_handles.values():
+                handle.release()
+
+
+    ##############################################
+    # Step 5: Display and Visualize Data for Each Dataflow
+    ##############################################
+    if "flow_handles" in st.session_state:
+        st.subheader("Fetched Data by Dataflow")
+
+        # Look up this session's flows in the shared dataset store
+        flow_results = {}
+        for flow, handle in st.session_state["flow_handles"].items():
+            result = handle.result
+            if result["data"] is None:
+                st.error(f"The data of dataflow {flow} is no longer available, please fetch it again.")
             else:
-                st.error(f"API call for dataflow {flow} failed with status code: {response.status_code}. Trying fallback API.")
-                st.code(api_url_bis)
-                fallback_response = requests.get(api_url_bis)
-                if fallback_response.status_code == 200:
+                flow_results[flow] = result
+
+        # --- One archive with every fetched flow ---
+        if len(flow_results) > 1:
+            archive_flows = {flow: (result["data"], result["meta"]["version"]) for flow, result in flow_results.items()}
+            archive_format = st.selectbox("Download format for all data flows", list(EXPORT_FORMATS), key="export_format_all")
+            archive_file = existing_archive([version for _, version in archive_flows.values()], archive_format)
+            if archive_file is None and st.button(f"Prepare {archive_format} archive of all data flows", key="prepare_download_all"):
+                archive_file = export_archive(archive_flows, archive_format)
+            if archive_file is not None:
+                try:
+                    with open(archive_file, "rb") as f:
+                        st.download_button(label="Download all data flows (zip)", data=f, file_name="sdmx_data.zip", mime="application/zip", key="download_all")
+                except FileNotFoundError:
+                    # Pruned by another session since it was looked up: offer to prepare it again
+                    st.button(f"Prepare {archive_format} archive of all data flows", key="prepare_download_all")
+
+        for flow, result in flow_results.items():
+            # Columns were normalized and described once, when the flow was fetched
+            df_data = result["data"]
+            flow_meta = result["meta"]
+
+            # --- Show Available Indicators ---
+            unique_indicators = unique_values(flow_meta, df_data, "Indicator")
+            with st.expander(f"**Data for {flow} – indicators:** {' / '.join(unique_indicators)}", expanded=True):
+                st.dataframe(df_data)
+
+                # Add a download button for this dataflow
+                # (the file is only written when asked for, then reused for this version of the data)
+                export_format = st.selectbox(f"Download format for {flow}", list(EXPORT_FORMATS), key=f"export_format_{flow}")
+                export_file = existing_export(flow_meta["version"], export_format)
+                if export_file is None and st.button(f"Prepare {export_format} download", key=f"prepare_download_{flow}"):
+                    export_file = export_flow(df_data, flow_meta["version"], export_format)
+                if export_file is not None:
+                    extension, mime = EXPORT_FORMATS[export_format]
                     try:
-                        df_data_flow = pd.read_csv(StringIO(fallback_response.text))
-                        if "OBS_VALUE" in df_data_flow.columns:
-                            df_data_flow["OBS_VALUE"] = pd.to_numeric(df_data_flow["OBS_VALUE"], errors="coerce")
-                        df_data_flow["dataflow"] = flow
-                        flow_data[flow] = df_data_flow
-                    except Exception as e:
-                        st.error(f"Error reading CSV data for {flow} using fallback: {e}")
-                else:
-                    st.error(f"Fallback API call for dataflow {flow} failed with status code: {fallback_response.status_code}. Trying tertiary API.")
-                    st.code(api_url_ter)
-                    tertiary_response = requests.get(api_url_ter)
-                    if tertiary_response.status_code == 200:
-                        try:
-                            df_data_flow = pd.read_csv(StringIO(tertiary_response.text))
-                            if "OBS_VALUE" in df_data_flow.columns:
-                                df_data_flow["OBS_VALUE"] = pd.to_numeric(df_data_flow["OBS_VALUE"], errors="coerce")
-                            df_data_flow["dataflow"] = flow
-                            flow_data[flow] = df_data_flow
-                        except Exception as e:
-                            st.error(f"Error reading CSV data for {flow} using tertiary fallback: {e}")
+                        with open(export_file, "rb") as f:
+                            st.download_button(label=f"Download data as {export_format}", data=f, file_name=f"{flow}_data{extension}", mime=mime, key=f"download_{flow}")
+                    except FileNotFoundError:
+                        # Pruned by another session since it was looked up: offer to prepare it again
+                        st.button(f"Prepare {export_format} download", key=f"prepare_download_{flow}")
+
+                st.markdown("### Data filtering")
+                available_columns = flow_meta["columns"]
+
+
+                # --- Interactive Filter with Empty Default ---
+                # If "SEX" exists and has >1 unique value, prefill with "SEX"
+                default_filter_field = flow_meta["default_filter_field"]
+                default_filter_index = available_columns.index(default_filter_field) + 1 if default_filter_field else 0
+
+                filter_field_options = [""] + available_columns
+                filter_field = st.selectbox(f"Select field to filter by for {flow}", filter_field_options, index=default_filter_index, key=f"filter_field_{flow}")
+                selected_filter_value = None
+                if filter_field != "":
+                    filter_options = unique_values(flow_meta, df_data, filter_field)
+                    if filter_field == "SEX" and "_T" in filter_options:
+                        default_filter_value = "_T"
                     else:
-                        st.error(f"Tertiary API call for dataflow {flow} failed with status code: {tertiary_response.status_code}")
+                        default_filter_value = filter_options[0]
+                    selected_filter_value = st.selectbox(f"Select value for '{filter_field}' for {flow}", filter_options, index=filter_options.index(default_filter_value), key=f"filter_value_{flow}")
+                filtered = filtered_summary(flow_meta, df_data, filter_field, selected_filter_value)
+
+                st.markdown("### Graph layout")
+                # --- Axis Defaults ---
+                default_x = available_columns.index("TIME_PERIOD") if "TIME_PERIOD" in available_columns else 0
+                default_y = available_columns.index("OBS_VALUE") if "OBS_VALUE" in available_columns else 0
+
+                # --- Determine Color Grouping or Chart Title Based on Indicator Count ---
+                chart_title = None
+                group_options = ["None"] + available_columns
+                # First, check if "Geographical area" exists and has several unique values.
+                if "Geographical area" in available_columns and filtered["Geographical area"] > 1:
+                    default_index = group_options.index("Geographical area")
+                    group_col = st.selectbox(f"Select Color Grouping Column (optional) for {flow}", group_options, index=default_index, key=f"group_{flow}")
+                    st.info(f"For {flow}: Multiple unique geographical areas detected. Defaulting color grouping to 'Geographical area'.")
 
-            if flow_data:
-                st.session_state["flow_data"] = flow_data
+                elif "Indicator" in available_columns:
+                    if filtered["Indicator"] > 1:
+                        default_index = group_options.index("Indicator") if "Indicator" in group_options else 0
+                        group_col = st.selectbox(f"Select Color Grouping Column (optional) for {flow}", group_options, index=default_index, key=f"group_{flow}")
+                        st.info(f"For {flow}: Multiple unique indicators detected. Defaulting color grouping to 'Indicator'.")
+                    else:
+                        unique_indicator = filtered["first_indicator"]
+                        chart_title = unique_indicator
+                        group_col = st.selectbox(f"Select Color Grouping Column (optional) for {flow}", group_options, index=0, key=f"group_{flow}")
+                else:
+                    default_group = (group_options.index("Reference Areas") 
+                                     if ("Reference Areas" in available_columns and filtered["Reference Areas"] > 1)
+                                     else (group_options.index("sex") if "sex" in group_options else 0))
+                    group_col = st.selectbox(f"Select Color Grouping Column (optional) for {flow}", group_options, index=default_group, key=f"group_{flow}")
+
+                # --- Chart Type and Axis Selections ---
+                chart_types = ["Line Chart", "Bar Chart", "Scatter Plot"]
+                default_chart_index = 0 if filtered["rows"] > 1 else 1
+                chart_type = st.selectbox(f"Select Chart Type for {flow}", chart_types, index=default_chart_index, key=f"chart_type_{flow}")
+                x_axis = st.selectbox(f"Select X-axis Column for {flow}", available_columns, index=default_x, key=f"x_axis_{flow}")
+                y_axis = st.selectbox(f"Select Y-axis Column for {flow}", available_columns, index=default_y, key=f"y_axis_{flow}")
+
+                aggregation = st.selectbox(f"Select aggregation for {flow}", list(AGGREGATIONS), index=0, key=f"aggregation_{flow}")
+
+                # Automatically generate the graph based on the selections
+                # (aggregations and figures are cached per data version, filter and chart settings;
+                # large series are drawn with WebGL and downsampled)
+                group_by = group_col if group_col != "None" else None
+                figure_key = (flow_meta["version"], filter_field, selected_filter_value, x_axis, group_by, y_axis, aggregation, chart_type, chart_title)
+                try:
+                    fig, downsampling_note = cached_figure(
+                        figure_key,
+                        lambda: aggregate(flow_meta, df_data, filter_field, selected_filter_value, x_axis, group_by, y_axis, aggregation),
+                        chart_type, x_axis, y_axis, group_by, chart_title,
+                    )
+                except (TypeError, ValueError) as e:
+                    st.error(f"Cannot aggregate {y_axis} for {flow}: {e}")
+                    continue
+
+                if fig is None:
+                    st.info("Unsupported chart type selected.")
+                else:
+                    if downsampling_note:
+                        st.caption(downsampling_note)
+                    with span("render_chart", flow=flow):
+                        st.plotly_chart(fig, use_container_width=True, key=f"plotly_chart_{flow}")
 
 
 ##############################################
-# Step 5: Display and Visualize Data for Each Dataflow
+# Performance breakdown of this run
 ##############################################
-if "flow_data" in st.session_state:
-    st.subheader("Fetched Data by Dataflow")
-    for flow, df_data in st.session_state["flow_data"].items():
-
-        # st.text(df_data.columns)
-        # ---- Standardize Geographical Area Column Names ----
-        # Rename any column found in synonyms to "Geographical area"
-        rename_dict = {}
-        synonyms = ["Country", "Geographic area", "Geo area", "Reference Areas","Areas",'REGION','Reference Area']
-        for col in synonyms:
-            if col in df_data.columns and col != "Geographical area":
-                rename_dict[col] = "Geographical area"
-        if rename_dict:
-            df_data.rename(columns=rename_dict, inplace=True)
-
-        # st.text(df_data.columns)
-
-    for flow, df_data in st.session_state["flow_data"].items():
-        # Rename any column found in synonyms to "Indicator"
-        # st.text(df_data.columns)
-
-        rename_dict = {}
-        synonyms = ["Coverage Indicators","Coverage indicators",'Demographic indicators','Driver indicators','Tier 2 indicators', 'Situation Report Indicator']
-        for col in synonyms:
-            if col in df_data.columns and col != "Indicator":
-                rename_dict[col] = "Indicator"
-        if rename_dict:
-            df_data.rename(columns=rename_dict, inplace=True)
-        
-        # st.text(df_data.columns)
-
-        # --- Show Available Indicators ---
-        unique_indicators = sorted(df_data["Indicator"].dropna().unique(), key=lambda x: str(x))
-        with st.expander(f"**Data for {flow} – indicators:** {' / '.join(unique_indicators)}", expanded=True):
-            st.dataframe(df_data)
-
-            # Add a download button for this dataflow
-            csv_data = df_data.to_csv(index=False).encode("utf-8")
-            st.download_button(label="Download data as CSV", data=csv_data, file_name=f"{flow}_data.csv", mime="text/csv", key=f"download_{flow}")
-            
-            st.markdown("### Data filtering")
-            available_columns = df_data.columns.tolist()
-            
-
-            # --- Interactive Filter with Empty Default ---
-            # If "SEX" exists and has >1 unique value, prefill with "SEX"
-            if "SEX" in available_columns and df_data["SEX"].nunique() > 1:
-                default_filter_field = "SEX"
-                default_filter_index = available_columns.index("SEX") + 1
-            else:
-                default_filter_field = ""
-                default_filter_index = 0
-            
-            filter_field_options = [""] + available_columns
-            filter_field = st.selectbox(f"Select field to filter by for {flow}", filter_field_options, index=default_filter_index, key=f"filter_field_{flow}")
-            if filter_field != "":
-                filter_options = sorted(df_data[filter_field].dropna().unique(), key=lambda x: str(x))
-                if filter_field == "SEX" and "_T" in filter_options:
-                    default_filter_value = "_T"
-                else:
-                    default_filter_value = filter_options[0]
-                selected_filter_value = st.selectbox(f"Select value for '{filter_field}' for {flow}", filter_options, index=filter_options.index(default_filter_value), key=f"filter_value_{flow}")
-                df_filtered_vis = df_data[df_data[filter_field] == selected_filter_value]
-            else:
-                df_filtered_vis = df_data
-            
-            st.markdown("### Graph layout")
-            # --- Axis Defaults ---
-            default_x = available_columns.index("TIME_PERIOD") if "TIME_PERIOD" in available_columns else 0
-            default_y = available_columns.index("OBS_VALUE") if "OBS_VALUE" in available_columns else 0
-            
-            # --- Determine Color Grouping or Chart Title Based on Indicator Count ---
-            chart_title = None
-            group_options = ["None"] + available_columns
-            # First, check if "Geographical area" exists and has several unique values.
-            if "Geographical area" in available_columns and df_filtered_vis["Geographical area"].nunique() > 1:
-                default_index = group_options.index("Geographical area")
-                group_col = st.selectbox(f"Select Color Grouping Column (optional) for {flow}", group_options, index=default_index, key=f"group_{flow}")
-                st.info(f"For {flow}: Multiple unique geographical areas detected. Defaulting color grouping to 'Geographical area'.")
-            
-            elif "Indicator" in available_columns:
-                if df_filtered_vis["Indicator"].nunique() > 1:
-                    default_index = group_options.index("Indicator") if "Indicator" in group_options else 0
-                    group_col = st.selectbox(f"Select Color Grouping Column (optional) for {flow}", group_options, index=default_index, key=f"group_{flow}")
-                    st.info(f"For {flow}: Multiple unique indicators detected. Defaulting color grouping to 'Indicator'.")
-                else:
-                    unique_indicator = df_filtered_vis["Indicator"].unique()[0]
-                    chart_title = unique_indicator
-                    group_col = st.selectbox(f"Select Color Grouping Column (optional) for {flow}", group_options, index=0, key=f"group_{flow}")
-            else:
-                default_group = (group_options.index("Reference Areas") 
-                                 if ("Reference Areas" in available_columns and df_filtered_vis["Reference Areas"].nunique() > 1)
-                                 else (group_options.index("sex") if "sex" in group_options else 0))
-                group_col = st.selectbox(f"Select Color Grouping Column (optional) for {flow}", group_options, index=default_group, key=f"group_{flow}")
-            
-            # --- Chart Type and Axis Selections ---
-            chart_types = ["Line Chart", "Bar Chart", "Scatter Plot"]
-            default_chart_index = 0 if len(df_filtered_vis) > 1 else 1
-            chart_type = st.selectbox(f"Select Chart Type for {flow}", chart_types, index=default_chart_index, key=f"chart_type_{flow}")
-            x_axis = st.selectbox(f"Select X-axis Column for {flow}", available_columns, index=default_x, key=f"x_axis_{flow}")
-            y_axis = st.selectbox(f"Select Y-axis Column for {flow}", available_columns, index=default_y, key=f"y_axis_{flow}")
-            
-            # Automatically generate the graph based on the selections
-            if group_col != "None":
-                df_agg = df_filtered_vis.groupby([x_axis, group_col], as_index=False)[y_axis].mean()
-            else:
-                df_agg = df_filtered_vis.groupby(x_axis, as_index=False)[y_axis].mean()
-            
-            if chart_type == "Bar Chart":
-                fig = px.bar(df_agg, x=x_axis, y=y_axis, color=(group_col if group_col != "None" else None), barmode="group")
-            elif chart_type == "Line Chart":
-                fig = px.line(df_agg, x=x_axis, y=y_axis, color=(group_col if group_col != "None" else None), markers=True)
-            elif chart_type == "Scatter Plot":
-                fig = px.scatter(df_agg, x=x_axis, y=y_axis, color=(group_col if group_col != "None" else None))
-            else:
-                st.info("Unsupported chart type selected.")
-                fig = None
-            
-            if fig is not None and chart_title:
-                # Left-align the title (x=0 with left anchor)
-                fig.update_layout(title_text=chart_title, title_x=0, title_xanchor="left", title_font=dict(size=20))
-            
-            if fig is not None:
-                st.plotly_chart(fig, use_container_width=True, key=f"plotly_chart_{flow}")
-
-            print(chart_title)
-            print(df_filtered_vis["Indicator"].nunique())
-
+except PageEnd:
+    pass
+finally:
+    finish_run(run_trace)
+    if show_performance:
+        with performance_panel:
+            st.markdown("### Performance breakdown")
+            st.dataframe(pd.DataFrame(run_trace.summary(), columns=["stage", "calls", "seconds"]), hide_index=True)
+            st.json(dict(run_trace.counters))
+            st.markdown("**Shared dataset store**")
+            st.json(get_dataset_store().stats())
+            with st.expander("Prometheus metrics"):
+                st.code(prometheus_text())
@@ -0,0 +1,205 @@
+"""
+Headless batch export of SDMX data, without a Streamlit server.
+
+Reads a job file of selections, resolves them with the same mapping catalogue
+and SDMX key building as app.py, fetches every (selection, dataflow) in
+parallel with a request rate limit and retries, and writes partitioned Parquet:
+
+    <output>/selection=<name>/dataflow_id=<dataflow_id>/part-0.parquet
+
+Progress is checkpointed in <output>/_checkpoint.jsonl, so a run that is
+interrupted (or that had failures) only redoes the unfinished work when it is
+started again. Partial or stale data (a batch failed, or stored data was
+served because a refresh failed) is written but checkpointed as "incomplete",
+so it is fetched again on the next run.
+
+The job file is JSON: a list of selections (or one selection per line), e.g.
+    [{"name": "afg-immunization", "countries": ["Afghanistan"],
+      "indicators": ["DTP3 coverage"], "level": "National",
+      "categories": [], "dataflows": null}]
+"level" ("National" or "Subnational"), "categories" and "dataflows" are
+optional; by default every dataflow of the selection is exported.
+
+Usage:
+    python batch_export.py jobs.json --output exports/ --workers 4 --rate 5
+"""
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from dotenv import load_dotenv
+
+from helpers.cachehelpers import atomic_write
+from helpers.mappinghelpers import build_queries, get_mapping_etag, load_mapping_catalogue
+from helpers.metrichelpers import prometheus_text
+from helpers.sdmxhelpers import fetch_flow, set_rate_limit
+
+
+logger = logging.getLogger("batch_export")
+
+
+def read_jobs(path):
+    with open(path) as f:
+        text = f.read().strip()
+    if text.startswith("["):
+        jobs = json.loads(text)
+    else:
+        jobs = [json.loads(line) for line in text.splitlines() if line.strip()]
+    for i, job in enumerate(jobs):
+        job.setdefault("name", f"job-{i}")
+    return jobs
+
+
+def plan_tasks(mapping, jobs):
+    """
+    Expands each selection into one task per dataflow: (task id, selection
+    name, dataflow name, query).
+    """
+    tasks = []
+    for job in jobs:
+        level = None
+        national = job.get("level", "National") == "National"
+        if mapping.has_national:
+            level = 1 if national else 0
+        df_candidates = mapping.rows(job["countries"], level, job.get("categories") or None, job["indicators"])
+        flows = job.get("dataflows") or sorted(df_candidates["dataflow_name"].dropna().unique(), key=lambda x: str(x))
+        queries, missing = build_queries(df_candidates, flows, job["countries"], job["indicators"], national=national)
+        for flow in missing:
+            logger.warning("%s: no mapping data found for dataflow %s", job["name"], flow)
+        if not queries:
+            logger.warning("%s: no dataflows found for this selection", job["name"])
+        for flow, query in queries.items():
+            tasks.append((f"{job['name']}/{query['dataflow_id']}", job["name"], flow, query))
+    return tasks
+
+
+class Checkpoint:
+    """
+    Append-only record of finished tasks, read back when a run resumes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    entry = json.loads(line)
+                    if entry["status"] == "done":
+                        self.done.add(entry["task"])
+
+    def record(self, task_id, status, **details):
+        with self._lock, open(self.path, "a") as f:
+            f.write(json.dumps({"task": task_id, "status": status, "time": time.time(), **details}) + "\n")
+        if status == "done":
+            self.done.add(task_id)
+
+
+def _partition_value(value):
+    return "".join(c if c.isalnum() or c in "-_." else "_" for c in str(value))
+
+
+def run_task(task, output, retries):
+    """
+    Fetches one dataflow of a selection and writes it as Parquet. The whole
+    flow is fetched again when it failed, or came back partial or stale, on
+    a transient error that outlasted the retries of each request.
+    Returns (rows written, fetch status of the data written).
+    """
+    task_id, name, flow, query = task
+    for attempt in range(retries + 1):
+        result = fetch_flow(flow, query)
+        status = result["status"]
+        if status["complete"] or attempt == retries or not status["transient"]:
+            break
+        time.sleep(2 ** attempt)
+    if result["data"] is None:
+        errors = [text for kind, text in result["messages"] if kind == "error"]
+        raise RuntimeError("; ".join(errors) or "no data returned")
+
+    directory = os.path.join(output, f"selection={_partition_value(name)}", f"dataflow_id={_partition_value(query['dataflow_id'])}")
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, "part-0.parquet")
+    atomic_write(path, lambda tmp_path: result["data"].to_parquet(tmp_path, index=False))
+    return len(result["data"]), status
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("jobs", help="JSON job file of selections")
+    parser.add_argument("--output", default="exports", help="output directory")
+    parser.add_argument("--workers", type=int, default=4, help="dataflows fetched in parallel")
+    parser.add_argument("--rate", type=float, default=5.0, help="maximum SDMX requests per second (0 for no limit)")
+    parser.add_argument("--retries", type=int, default=2, help="retries of a dataflow that failed on a transient error")
+    parser.add_argument("--restart", action="store_true", help="ignore the checkpoint and export everything again")
+    parser.add_argument("--metrics", help="write the Prometheus metrics of the run to this file")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    load_dotenv()
+    connection_string = os.environ["CONNECTION_STRING_BLOB"]
+    container_name = os.environ["CONTAINER_NAME"]
+    blob_name = os.environ["MAPPING_FILE_NAME"]
+
+    mapping = load_mapping_catalogue(
+        connection_string, container_name, blob_name, get_mapping_etag(connection_string, container_name, blob_name)
+    )
+    tasks = plan_tasks(mapping, read_jobs(args.jobs))
+
+    os.makedirs(args.output, exist_ok=True)
+    checkpoint_path = os.path.join(args.output, "_checkpoint.jsonl")
+    if args.restart and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    checkpoint = Checkpoint(checkpoint_path)
+    pending = [task for task in tasks if task[0] not in checkpoint.done]
+    logger.info("%d tasks, %d already done, %d to run", len(tasks), len(tasks) - len(pending), len(pending))
+
+    set_rate_limit(args.rate or None)
+    failed = incomplete = 0
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        futures = {executor.submit(run_task, task, args.output, args.retries): task for task in pending}
+        for future in as_completed(futures):
+            task_id = futures[future][0]
+            try:
+                rows, status = future.result()
+            except Exception as e:
+                failed += 1
+                checkpoint.record(task_id, "failed", error=str(e))
+                logger.error("%s failed: %s", task_id, e)
+            else:
+                if status["complete"]:
+                    checkpoint.record(task_id, "done", rows=rows)
+                    logger.info("%s: %d rows", task_id, rows)
+                    continue
+                # Written, but fetched again on the next run
+                incomplete += 1
+                checkpoint.record(
+                    task_id, "incomplete", rows=rows, partial=status["partial"], stale=status["stale"],
+                    failed_batches=status["failed_batches"], batches=status["batches"],
+                    http_status=status["http_status"], error=status["error"],
+                )
+                logger.warning(
+                    "%s: %d rows, incomplete (%d of %d batches failed, stale: %s, last status: %s, error: %s)",
+                    task_id, rows, status["failed_batches"], status["batches"], status["stale"],
+                    status["http_status"], status["error"],
+                )
+
+    if args.metrics:
+        with open(args.metrics, "w") as f:
+            f.write(prometheus_text())
+    logger.info("finished: %d done, %d incomplete, %d failed", len(pending) - failed - incomplete, incomplete, failed)
+    return 1 if failed or incomplete else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,263 @@
+"""
+Local mock of the UNICEF SDMX REST API and of the mapping blob, for the benchmarks.
+
+The mock serves:
+- dataflow/{agency}/{id}/{version}?references=datastructure: an SDMX-ML data
+  structure with REF_AREA, INDICATOR, SEX, DIM_1..DIM_n and TIME_PERIOD;
+- data/{agency},{id},{version}/{key}?format=csv&labels=both: a synthetic CSV
+  payload (codes and labels) for the geographies and indicators of the key;
+  codes only with labels=id.
+  With updatedAfter or startPeriod, only the latest `updated_periods` years
+  are returned, as if they were the ones revised since the last sync.
+- codelist/{agency}/{id}/{version}: the codes and names of REF_AREA, SEX and
+  the extra dimensions.
+Payload size, latency and failure rate are configurable.
+"""
+import gzip
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import StringIO
+from urllib.parse import urlsplit
+
+
+class MockConfig:
+    def __init__(
+        self,
+        rows_per_series=40,
+        extra_dimensions=2,
+        values_per_dimension=3,
+        latency=0.05,
+        failure_rate=0.0,
+        updated_periods=1,
+        seed=0,
+    ):
+        # rows_per_series: observations returned per geography x indicator
+        self.rows_per_series = rows_per_series
+        self.extra_dimensions = extra_dimensions
+        self.values_per_dimension = values_per_dimension
+        # seconds added to every response, and share of data requests answered with 503
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.updated_periods = updated_periods
+        self.seed = seed
+
+
+def structure_xml(config):
+    dims = ["REF_AREA", "INDICATOR", "SEX"] + [f"DIM_{i}" for i in range(1, config.extra_dimensions + 1)]
+    dimension_xml = "".join(
+        f'<s:Dimension id="{dim}" position="{position}"><s:LocalRepresentation><s:Enumeration>'
+        f'<Ref id="CL_{dim}" agencyID="MOCK" version="1.0"/></s:Enumeration></s:LocalRepresentation></s:Dimension>'
+        for position, dim in enumerate(dims, start=1)
+    )
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        '<m:Structure xmlns:m="http://www.sdmx.org/resources/sdmxml/schemas/v2_1/message" '
+        'xmlns:s="http://www.sdmx.org/resources/sdmxml/schemas/v2_1/structure">'
+        '<m:Structures><s:DataStructures><s:DataStructure id="DSD_MOCK"><s:DataStructureComponents>'
+        f'<s:DimensionList>{dimension_xml}'
+        f'<s:TimeDimension id="TIME_PERIOD" position="{len(dims) + 1}"/></s:DimensionList>'
+        '</s:DataStructureComponents></s:DataStructure></s:DataStructures></m:Structures></m:Structure>'
+    ).encode("utf-8")
+
+
+def codelist_xml(config, codelist_id, geographies):
+    if codelist_id == "CL_REF_AREA":
+        codes = [(geo, f"Mock area {geo}") for geo in geographies]
+    elif codelist_id == "CL_SEX":
+        codes = [("_T", "Total"), ("F", "Female"), ("M", "Male")]
+    elif codelist_id.startswith("CL_DIM_"):
+        dim = codelist_id[3:]
+        codes = [(f"{dim}_{code}", f"{dim.title()} value {code}") for code in range(config.values_per_dimension)]
+    else:
+        codes = []
+    code_xml = "".join(f'<s:Code id="{code}"><c:Name xml:lang="en">{name}</c:Name></s:Code>' for code, name in codes)
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        '<m:Structure xmlns:m="http://www.sdmx.org/resources/sdmxml/schemas/v2_1/message" '
+        'xmlns:s="http://www.sdmx.org/resources/sdmxml/schemas/v2_1/structure" '
+        'xmlns:c="http://www.sdmx.org/resources/sdmxml/schemas/v2_1/common">'
+        f'<m:Structures><s:Codelists><s:Codelist id="{codelist_id}">{code_xml}</s:Codelist></s:Codelists></m:Structures></m:Structure>'
+    ).encode("utf-8")
+
+
+def data_csv(config, flow_ref, geographies, indicators, labels="both"):
+    """
+    Builds the CSV payload of a query: rows_per_series rows for every
+    geography x indicator, spread over SEX, the extra dimensions and years.
+    With labels="id" the label columns are left out.
+    """
+    rng = random.Random(f"{config.seed}/{flow_ref}/{'+'.join(geographies)}/{'+'.join(indicators)}")
+    extra = [f"DIM_{i}" for i in range(1, config.extra_dimensions + 1)]
+    header = ["DATAFLOW", "REF_AREA", "Geographic area", "INDICATOR", "Indicator", "SEX", "Sex"]
+    for dim in extra:
+        header += [dim, dim.replace("_", " ").title()]
+    header += ["TIME_PERIOD", "OBS_VALUE", "UNIT_MEASURE", "Unit of measure"]
+
+    # Codes are in the upper case id columns, labels=id leaves out the label columns
+    keep = list(range(len(header)))
+    if labels == "id":
+        keep = [i for i, name in enumerate(header) if name.isupper() or name == "OBS_VALUE"]
+    out = StringIO()
+    out.write(",".join(header[i] for i in keep) + "\n")
+    sexes = [("_T", "Total"), ("F", "Female"), ("M", "Male")]
+    # SDMX-CSV writes the dataflow as AGENCY:ID(VERSION); the comma-separated URL form would add fields
+    agency, dataflow_id, version = (flow_ref.split(",") + ["", "", ""])[:3]
+    dataflow = f"{agency}:{dataflow_id}({version or '1.0'})"
+    for geo in geographies:
+        for indicator in indicators:
+            for i in range(config.rows_per_series):
+                sex = sexes[i % len(sexes)]
+                row = [dataflow, geo, f"Mock area {geo}", indicator, f"Mock indicator {indicator} with a long label", sex[0], sex[1]]
+                for dim in extra:
+                    code = rng.randrange(config.values_per_dimension)
+                    row += [f"{dim}_{code}", f"{dim.title()} value {code}"]
+                row += [str(1990 + i // len(sexes) % 35), f"{rng.uniform(0, 100):.2f}", "PCNT", "Percentage"]
+                out.write(",".join(row[i] for i in keep) + "\n")
+    return out.getvalue().encode("utf-8")
+
+
+class MockSdmxServer:
+    """
+    Runs the mock API in a background thread on 127.0.0.1.
+    `base_url` is the value to use for SDMX_API_URL.
+    """
+
+    def __init__(self, config, all_geographies=None):
+        self.config = config
+        # An empty geography key (subnational queries) means every geography
+        self.all_geographies = all_geographies or [f"C{i:03d}" for i in range(10)]
+        self.requests = 0
+        self.bytes_sent = 0
+        self._lock = threading.Lock()
+        self._rng = random.Random(config.seed)
+        self._payloads = {}
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.base_url = f"http://127.0.0.1:{self.server.server_address[1]}/ws/public/sdmxapi/rest/"
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def payload(self, path, labels="both"):
+        if (path, labels) not in self._payloads:
+            flow_ref, _, key = path.partition("/data/")[2].partition("/")
+            parts = key.split(".")
+            geographies = [g for g in parts[0].split("+") if g] or self.all_geographies
+            indicators = [i for i in parts[1].split("+") if i] if len(parts) > 1 else ["IND"]
+            self._payloads[(path, labels)] = data_csv(self.config, flow_ref, geographies, indicators, labels)
+        return self._payloads[(path, labels)]
+
+    def delta_payload(self, path, labels="both"):
+        """
+        The rows of the latest `updated_periods` years of a payload.
+        """
+        lines = self.payload(path, labels).decode("utf-8").splitlines()
+        column = lines[0].split(",").index("TIME_PERIOD")
+        periods = sorted({line.split(",")[column] for line in lines[1:]})
+        latest = set(periods[-self.config.updated_periods:])
+        rows = [line for line in lines[1:] if line.split(",")[column] in latest]
+        return "\n".join([lines[0]] + rows).encode("utf-8") + b"\n"
+
+    def _handler(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                parts = urlsplit(self.path)
+                path = parts.path
+                time.sleep(mock.config.latency)
+                with mock._lock:
+                    mock.requests += 1
+                    fail = mock._rng.random() < mock.config.failure_rate
+                labels = "id" if "labels=id" in parts.query else "both"
+                if "/dataflow/" in path:
+                    self._send(200, structure_xml(mock.config), "application/xml")
+                elif "/codelist/" in path:
+                    codelist_id = path.rstrip("/").split("/")[-2]
+                    self._send(200, codelist_xml(mock.config, codelist_id, mock.all_geographies), "application/xml")
+                elif "/data/" in path:
+                    if fail:
+                        self._send(503, b"Service unavailable", "text/plain")
+                    elif "updatedAfter=" in parts.query or "startPeriod=" in parts.query:
+                        self._send(200, mock.delta_payload(path, labels), "text/csv")
+                    else:
+                        self._send(200, mock.payload(path, labels), "text/csv")
+                else:
+                    self._send(404, b"Not found", "text/plain")
+
+            def _send(self, status, body, content_type):
+                headers = {"Content-Type": content_type}
+                if "gzip" in self.headers.get("Accept-Encoding", ""):
+                    body = gzip.compress(body, compresslevel=1)
+                    headers["Content-Encoding"] = "gzip"
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                with mock._lock:
+                    mock.bytes_sent += len(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+class StubBlobClient:
+    """
+    Stand-in for the azure BlobClient of the mapping file: serves bytes from
+    memory with a fixed ETag.
+    """
+
+    class _Properties:
+        def __init__(self, etag, size):
+            self.etag = etag
+            self.size = size
+
+    class _Download:
+        def __init__(self, data, properties):
+            self._data = data
+            self.properties = properties
+
+        def readall(self):
+            return self._data
+
+        def content_as_text(self):
+            return self._data.decode("utf-8")
+
+    def __init__(self, data, etag='"0x1"'):
+        self.data = data
+        self.etag = etag
+
+    def get_blob_properties(self):
+        return self._Properties(self.etag, len(self.data))
+
+    def download_blob(self):
+        return self._Download(self.data, self.get_blob_properties())
+
+
+def mapping_csv(countries, indicators, flows):
+    """
+    Builds a synthetic mapping file with the columns app.py expects.
+    """
+    out = StringIO()
+    out.write("dataflow_name,agency,dataflow_id,geography,geography_id,indicator,indicator_id,category,country,national\n")
+    for c in range(countries):
+        for i in range(indicators):
+            flow = i % flows
+            out.write(
+                f"Mock flow {flow},MOCK,FLOW_{flow},C{c:03d},C{c:03d},Mock indicator {i},IND_{i:04d},"
+                f"Category {i % 12},Country {c:03d},1\n"
+            )
+    return out.getvalue().encode("utf-8")
@@ -0,0 +1,208 @@
+"""
+Offline benchmarks of the explorer's stages against the local mock API.
+
+Reports p50/p95 latency, throughput and peak traced memory for: mapping load
+(CSV and Parquet snapshot), the mapping cascade, fetch (cold caches, cached,
+and incremental updatedAfter refresh of the series store), parse, normalize, aggregate and plot. Peak memory is what
+tracemalloc sees (Python and numpy allocations, not pyarrow buffers).
+
+Run from the repository root, e.g.:
+    python -m benchmarks.run --flows 4 --countries 30 --indicators 3 --rows-per-series 200 --latency 0.05 --failure-rate 0.05
+"""
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+import uuid
+from urllib.parse import urlsplit
+
+from benchmarks.mock_sdmx import MockConfig, MockSdmxServer, StubBlobClient, mapping_csv
+
+
+def percentile(values, q):
+    values = sorted(values)
+    index = min(int(round(q / 100 * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+
+def measure(name, func, repeat, setup=None):
+    """
+    Runs `func` `repeat` times (after `setup`, which is not timed) and returns
+    its latency percentiles and throughput, then runs it once more under
+    tracemalloc for its peak memory (tracing slows Python code down, so it
+    is kept out of the timed runs).
+    `func` returns the number of rows it processed.
+    """
+    durations, rows = [], 0
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        rows = func()
+        durations.append(time.perf_counter() - start)
+
+    if setup is not None:
+        setup()
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    p50 = percentile(durations, 50)
+    return {
+        "stage": name,
+        "runs": repeat,
+        "rows": rows,
+        "p50_ms": p50 * 1000,
+        "p95_ms": percentile(durations, 95) * 1000,
+        "rows_per_s": rows / p50 if p50 > 0 else 0.0,
+        "peak_mb": peak / 1024 / 1024,
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--flows", type=int, default=3, help="dataflows fetched together")
+    parser.add_argument("--countries", type=int, default=20, help="countries selected per query")
+    parser.add_argument("--indicators", type=int, default=1, help="indicators selected per flow")
+    parser.add_argument("--rows-per-series", type=int, default=100, help="rows returned per country x indicator")
+    parser.add_argument("--extra-dimensions", type=int, default=2, help="dimensions besides area, indicator and sex")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds added to each mock response")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="share of data requests answered with 503")
+    parser.add_argument("--mapping-countries", type=int, default=200)
+    parser.add_argument("--mapping-indicators", type=int, default=500)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--json", help="also write the results to this file")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    cache_dir = tempfile.mkdtemp(prefix="sdmx-bench-")
+    # The helpers read their configuration when first imported
+    os.environ["SDMX_CACHE_DIR"] = cache_dir
+
+    config = MockConfig(
+        rows_per_series=args.rows_per_series,
+        extra_dimensions=args.extra_dimensions,
+        latency=args.latency,
+        failure_rate=args.failure_rate,
+    )
+    geographies = [f"C{i:03d}" for i in range(args.countries)]
+    results = []
+    with MockSdmxServer(config, geographies) as server:
+        os.environ["SDMX_API_URL"] = server.base_url
+        from helpers import cachehelpers, mappinghelpers, plothelpers, sdmxhelpers, serieshelpers
+        from helpers.datahelpers import aggregate, describe_flow, normalize_columns
+
+        # --- Mapping catalogue, served by a blob stub ---
+        mapping_blob = StubBlobClient(mapping_csv(args.mapping_countries, args.mapping_indicators, max(args.flows, 1)))
+        mappinghelpers._mapping_blob_client = lambda *blob_args: mapping_blob
+
+        def load_mapping():
+            return len(mappinghelpers.load_mapping_catalogue("", "", "", mapping_blob.etag).df)
+
+        def clear_snapshots():
+            shutil.rmtree(mappinghelpers.MAPPING_CACHE_DIR, ignore_errors=True)
+
+        results.append(measure("mapping load (CSV)", load_mapping, args.repeat, setup=clear_snapshots))
+        results.append(measure("mapping load (Parquet)", load_mapping, args.repeat))
+
+        catalogue = mappinghelpers.load_mapping_catalogue("", "", "", mapping_blob.etag)
+        selected = catalogue.countries[: args.countries]
+
+        def cascade():
+            indicators = catalogue.indicators(selected, 1)
+            return len(catalogue.rows(selected, 1, None, indicators[: args.indicators]))
+
+        results.append(measure("mapping cascade", cascade, args.repeat))
+
+        # --- Fetch through the mock API ---
+        jobs = {
+            f"Mock flow {f}": {
+                "agency": "MOCK",
+                "dataflow_id": f"FLOW_{f}",
+                "geography_ids": geographies,
+                "geographies": geographies,
+                "indicator_ids": [f"IND_{f * args.indicators + i:04d}" for i in range(args.indicators)],
+                "national": True,
+            }
+            for f in range(args.flows)
+        }
+
+        def fetch():
+            rows = 0
+            for result in sdmxhelpers.fetch_flows(jobs):
+                if result["data"] is not None:
+                    rows += len(result["data"])
+            return rows
+
+        def fresh_caches():
+            path = os.path.join(cache_dir, f"responses-{uuid.uuid4().hex}.sqlite")
+            cachehelpers._response_cache = cachehelpers.ResponseCache(path)
+            serieshelpers._series_store = serieshelpers.SeriesStore(os.path.join(cache_dir, f"series-{uuid.uuid4().hex}"))
+
+        def expire_series():
+            # Every stored series is due for a refresh
+            serieshelpers.get_series_store().ttl_for = lambda url: 0
+
+        requests_before = server.requests
+        results.append(measure("fetch (cold cache)", fetch, args.repeat, setup=fresh_caches))
+        results.append(measure("fetch (cached)", fetch, args.repeat))
+        results.append(measure("fetch (incremental)", fetch, args.repeat, setup=expire_series))
+        requests_made = server.requests - requests_before
+
+        # --- Parse, normalize, aggregate and plot one payload ---
+        first_query = next(iter(jobs.values()))
+        payload_path = urlsplit(sdmxhelpers.data_url(first_query, "+".join(geographies) + "." + "+".join(first_query["indicator_ids"]))).path
+        body = server.payload(payload_path)
+        results.append(measure("parse", lambda: len(sdmxhelpers.parse_sdmx_csv(body, "Mock flow 0")), args.repeat))
+
+        df = sdmxhelpers.parse_sdmx_csv(body, "Mock flow 0")
+
+        def normalize():
+            return len(describe_flow(normalize_columns(df))["columns"]) and len(df)
+
+        results.append(measure("normalize", normalize, args.repeat))
+
+        df = normalize_columns(df)
+        meta = describe_flow(df)
+
+        def new_version():
+            # A new data version misses the aggregation cache
+            meta["version"] = uuid.uuid4().hex
+
+        def aggregate_stage():
+            aggregate(meta, df, "SEX", "_T", "TIME_PERIOD", "Geographical area", "OBS_VALUE", "Mean")
+            return len(df)
+
+        results.append(measure("aggregate", aggregate_stage, args.repeat, setup=new_version))
+
+        df_agg = aggregate(meta, df, "", None, "TIME_PERIOD", "Geographical area", "OBS_VALUE", "Mean")
+
+        def plot():
+            fig, _ = plothelpers.build_figure(df_agg, "Line Chart", "TIME_PERIOD", "OBS_VALUE", "Geographical area")
+            fig.to_json()
+            return len(df_agg)
+
+        results.append(measure("plot (build + serialize)", plot, args.repeat))
+
+    print(f"{'stage':<26}{'runs':>6}{'rows':>10}{'p50 ms':>11}{'p95 ms':>11}{'rows/s':>13}{'peak MB':>10}")
+    for r in results:
+        print(
+            f"{r['stage']:<26}{r['runs']:>6}{r['rows']:>10}{r['p50_ms']:>11.1f}{r['p95_ms']:>11.1f}"
+            f"{r['rows_per_s']:>13,.0f}{r['peak_mb']:>10.1f}"
+        )
+    print(f"\nmock API: {requests_made} requests during the fetch stages, {server.bytes_sent / 1024 / 1024:.1f} MB sent in total")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"args": vars(args), "results": results}, f, indent=2)
+    shutil.rmtree(cache_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
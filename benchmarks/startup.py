@@ -0,0 +1,106 @@
+"""
+Startup-time report: how long a fresh interpreter takes to import each
+helper module (and the modules app.py imports), from `python -X importtime`.
+
+For each target it reports the cumulative import time, which of the heavy
+optional dependencies (GenAI, blob SDK, streamlit) it pulled in, and the
+slowest imports underneath it.
+
+Run from the repository root, e.g.:
+    python -m benchmarks.startup --top 10
+"""
+import argparse
+import json
+import subprocess
+import sys
+
+
+TARGETS = [
+    "helpers.azhelpers",
+    "helpers.cachehelpers",
+    "helpers.metrichelpers",
+    "helpers.datahelpers",
+    "helpers.sdmxhelpers",
+    "helpers.mappinghelpers",
+    "helpers.searchhelpers",
+    "helpers.plothelpers",
+    "helpers.exporthelpers",
+]
+
+# Dependencies that should only load when a feature needs them
+HEAVY_MODULES = ["openai", "llama_index", "azure.storage.blob", "streamlit"]
+
+
+def import_profile(module):
+    """
+    Imports `module` in a fresh interpreter with -X importtime. Returns the
+    cumulative time in milliseconds of `module` and of every module it
+    imported (by nesting depth, 1 being its direct imports), and the error
+    of a failed import.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+    )
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip())) // 2
+        rows.append((name.strip(), depth, int(cumulative) / 1000))
+    # The modules imported by the target are listed right before it, nested
+    # deeper; what comes earlier was loaded by the interpreter itself
+    imported = []
+    for name, depth, ms in reversed(rows):
+        if imported and depth == 0:
+            break
+        if imported or name == module.split(".")[0] or name == module:
+            imported.append((name, depth, ms))
+    error = None
+    if result.returncode != 0:
+        error = result.stderr.strip().splitlines()[-1]
+    return imported[::-1], error
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("targets", nargs="*", default=TARGETS, help="modules to import")
+    parser.add_argument("--top", type=int, default=5, help="slowest imports listed per target")
+    parser.add_argument("--json", help="also write the results to this file")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    results = []
+    for module in args.targets:
+        imported, error = import_profile(module)
+        names = {name for name, _, _ in imported}
+        heavy = [name for name in HEAVY_MODULES if name in names]
+        slowest = sorted(((name, ms) for name, depth, ms in imported if depth == 1), key=lambda item: -item[1])
+        results.append({
+            "module": module,
+            "import_ms": sum(ms for _, depth, ms in imported if depth == 0),
+            "heavy_modules": heavy,
+            "slowest": slowest[: args.top],
+            "error": error,
+        })
+
+    print(f"{'module':<26}{'import ms':>11}  heavy dependencies loaded")
+    for r in results:
+        heavy = ", ".join(r["heavy_modules"]) or "-"
+        print(f"{r['module']:<26}{r['import_ms']:>11.1f}  {heavy}")
+        if r["error"]:
+            print(f"    failed: {r['error']}")
+        for name, ms in r["slowest"]:
+            print(f"    {name:<30}{ms:>9.1f} ms")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
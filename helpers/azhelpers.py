@@ -1,71 +1,313 @@
-
-import openai
-import llama_index
-from llama_index.llms.openai import OpenAI
-
-try:
-    from llama_index import (
-        VectorStoreIndex,
-        ServiceContext,
-        Document,
-        SimpleDirectoryReader,
-    )
-except ImportError:
-    from llama_index.core import (
-        VectorStoreIndex,
-        ServiceContext,
-        Document,
-        SimpleDirectoryReader,
-    )
-
-from azure.storage.blob import BlobServiceClient
-from io import BytesIO
-
-from llama_index.core.extractors import (
-    TitleExtractor,
-    QuestionsAnsweredExtractor,
-)
-from llama_index.core.node_parser import TokenTextSplitter
-import streamlit as st
+import datetime
+import importlib
 import logging
-import os 
-import dotenv
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from azure.core.exceptions import HttpResponseError, ResourceNotFoundError
 from dotenv import load_dotenv
 
+from helpers.cachehelpers import atomic_write
+
 load_dotenv()
 
-azure_storage_account_name = os.environ["AZURE_STORAGE_ACCOUNT_NAME"]
-azure_storage_account_key = os.environ["AZURE_STORAGE_ACCOUNT_KEY"]
-connection_string_blob = os.environ["CONNECTION_STRING_BLOB"]
 container_name = None
-logging_container_name = os.environ["LOGGING_CONTAINER_NAME"]
-blob_service_client = BlobServiceClient.from_connection_string(f"DefaultEndpointsProtocol=https;AccountName={azure_storage_account_name};AccountKey={azure_storage_account_key}")
+
+# Settings read from the environment when first used rather than at import,
+# e.g. `azhelpers.logging_container_name`
+_SETTINGS = {
+    "azure_storage_account_name": "AZURE_STORAGE_ACCOUNT_NAME",
+    "azure_storage_account_key": "AZURE_STORAGE_ACCOUNT_KEY",
+    "connection_string_blob": "CONNECTION_STRING_BLOB",
+    "logging_container_name": "LOGGING_CONTAINER_NAME",
+}
+
+# The GenAI dependencies take seconds to import and most sessions never use
+# them, so they are imported on first access (`from helpers.azhelpers import
+# OpenAI` still works). Each name lists the modules to try in turn.
+_LAZY_IMPORTS = {
+    "openai": ["openai"],
+    "llama_index": ["llama_index"],
+    "OpenAI": ["llama_index.llms.openai"],
+    "VectorStoreIndex": ["llama_index", "llama_index.core"],
+    "ServiceContext": ["llama_index", "llama_index.core"],
+    "Document": ["llama_index", "llama_index.core"],
+    "SimpleDirectoryReader": ["llama_index", "llama_index.core"],
+    "TitleExtractor": ["llama_index.core.extractors"],
+    "QuestionsAnsweredExtractor": ["llama_index.core.extractors"],
+    "TokenTextSplitter": ["llama_index.core.node_parser"],
+}
+
+
+def _lazy_import(name):
+    error = None
+    for module_name in _LAZY_IMPORTS[name]:
+        try:
+            module = importlib.import_module(module_name)
+        except ImportError as e:
+            error = e
+            continue
+        if module_name == name:
+            return module
+        if hasattr(module, name):
+            return getattr(module, name)
+    raise ImportError(f"cannot import {name} from {', '.join(_LAZY_IMPORTS[name])}: {error}")
+
+
+def __getattr__(name):
+    if name in _SETTINGS:
+        return os.environ[_SETTINGS[name]]
+    if name == "blob_service_client":
+        return get_blob_service_client()
+    if name in _LAZY_IMPORTS:
+        value = _lazy_import(name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_blob_service_client(connection_string=None, **config):
+    """
+    Returns the BlobServiceClient of a connection string (by default the
+    account of AZURE_STORAGE_ACCOUNT_NAME / AZURE_STORAGE_ACCOUNT_KEY), with
+    optional client settings such as max_block_size.
+    Clients are created on first use and shared by the whole process, so
+    their HTTP connections are reused too.
+    """
+    if connection_string is None:
+        connection_string = (
+            f"DefaultEndpointsProtocol=https;AccountName={os.environ['AZURE_STORAGE_ACCOUNT_NAME']};"
+            f"AccountKey={os.environ['AZURE_STORAGE_ACCOUNT_KEY']}"
+        )
+    key = (connection_string, tuple(sorted(config.items())))
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            # Imported here: the blob SDK alone adds a quarter of a second to startup
+            from azure.storage.blob import BlobServiceClient
+
+            client = BlobServiceClient.from_connection_string(connection_string, **config)
+            _clients[key] = client
+    return client
+
+
+APPEND_BLOCK_MAX_BYTES = 4 * 1024 * 1024
+# An append blob takes at most this many blocks
+APPEND_BLOCK_MAX_COUNT = 50000
+
+# Bulk operations: a blob batch request deletes at most 256 blobs, and
+# transfers are split into blocks / ranges moved over parallel connections
+BATCH_DELETE_MAX_BLOBS = 256
+LIST_PAGE_SIZE = 1000
+MAX_CONCURRENCY = 4
+TRANSFER_CONFIG = {
+    "max_single_put_size": 8 * 1024 * 1024,
+    "max_block_size": 4 * 1024 * 1024,
+    "max_single_get_size": 8 * 1024 * 1024,
+    "max_chunk_get_size": 4 * 1024 * 1024,
+}
 
 
 
 class AzureBlobStorageHandler(logging.Handler):
-    def __init__(self, connection_string, container_name, blob_name):
+    """
+    Non-blocking logging handler writing to Azure Append Blobs.
+    emit() only puts the formatted record on a bounded queue; a background
+    thread writes the records in batches (every `batch_size` records or
+    `flush_interval` seconds) with append_block. Blobs are rotated every day,
+    when they reach `max_blob_bytes` and when they run out of blocks (other
+    processes may append to the same blob). When storage is slow and the queue
+    is full, records are dropped (overflow="drop") or the caller waits up to
+    `block_timeout` seconds (overflow="block"). Records kept for a retry
+    while writes fail are capped at `max_pending_bytes`, the oldest being
+    dropped first. Dropped records are counted in `dropped`.
+    """
+
+    def __init__(
+        self,
+        connection_string,
+        container_name,
+        blob_name,
+        container_client=None,
+        batch_size=100,
+        flush_interval=5.0,
+        max_blob_bytes=64 * 1024 * 1024,
+        queue_size=10000,
+        overflow="drop",
+        block_timeout=1.0,
+        max_pending_bytes=16 * 1024 * 1024,
+    ):
         super().__init__()
         self.connection_string = connection_string
         self.container_name = container_name
         self.blob_name = blob_name
-        self.blob_service_client = blob_service_client
-        self.container_client = self.blob_service_client.get_container_client(
-            container_name
-        )
+        if container_client is None:
+            container_client = get_blob_service_client().get_container_client(container_name)
+        self.container_client = container_client
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_blob_bytes = max_blob_bytes
+        self.overflow = overflow
+        self.block_timeout = block_timeout
+        self.max_pending_bytes = max_pending_bytes
+        self.dropped = 0
 
-    def emit(self, record):
-        log_entry = self.format(record)
-        self.append_log_to_blob(log_entry)
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._day = None
+        self._part = 0
+        self._current_size = None
+        self._current_blocks = 0
+        self._pending = deque()
+        self._pending_bytes = 0
+        self._stop = threading.Event()
+        self._flushed = threading.Condition()
+        self._flush_requested = False
+        self._thread = threading.Thread(target=self._run, name="azure-log-flusher", daemon=True)
+        self._thread.start()
 
-    def append_log_to_blob(self, log_entry):
-        blob_client = self.container_client.get_blob_client(self.blob_name)
+    def emit(self, record):
         try:
-            blob_data = blob_client.download_blob().content_as_text()
-        except:
-            blob_data = ""
-        updated_log_data = blob_data + "\n" + log_entry
-        blob_client.upload_blob(updated_log_data, overwrite=True)
+            log_entry = self.format(record)
+        except Exception:
+            self.handleError(record)
+            return
+        try:
+            if self.overflow == "block":
+                self._queue.put(log_entry, timeout=self.block_timeout)
+            else:
+                self._queue.put_nowait(log_entry)
+        except queue.Full:
+            self.dropped += 1
+
+    def _blob_name_for(self, day, part):
+        base, ext = os.path.splitext(self.blob_name)
+        suffix = f".{part}" if part else ""
+        return f"{base}-{day}{suffix}{ext or '.log'}"
+
+    def _open_blob(self, incoming_bytes):
+        """
+        Returns the blob client to append to, rotating to a new blob on a new
+        day, when the current one would exceed max_blob_bytes or when it
+        has no block left.
+        """
+        day = datetime.date.today().isoformat()
+        if day != self._day:
+            self._day, self._part, self._current_size = day, 0, None
+        while True:
+            blob_client = self.container_client.get_blob_client(self._blob_name_for(day, self._part))
+            if self._current_size is None:
+                try:
+                    properties = blob_client.get_blob_properties()
+                    self._current_size = properties.size
+                    self._current_blocks = properties.append_blob_committed_block_count or 0
+                except ResourceNotFoundError:
+                    blob_client.create_append_blob()
+                    self._current_size = 0
+                    self._current_blocks = 0
+            fits = self._current_size == 0 or self._current_size + incoming_bytes <= self.max_blob_bytes
+            if fits and self._current_blocks < APPEND_BLOCK_MAX_COUNT:
+                return blob_client
+            self._part += 1
+            self._current_size = None
+
+    def _write(self, data):
+        # An append block is at most 4 MiB
+        for start in range(0, len(data), APPEND_BLOCK_MAX_BYTES):
+            block = data[start:start + APPEND_BLOCK_MAX_BYTES]
+            while True:
+                blob_client = self._open_blob(len(block))
+                try:
+                    blob_client.append_block(block)
+                except HttpResponseError as e:
+                    # The other writers of the blob used its last blocks: move to the next part
+                    if e.error_code != "BlockCountExceedsLimit":
+                        raise
+                    self._part += 1
+                    self._current_size = None
+                    continue
+                self._current_size += len(block)
+                self._current_blocks += 1
+                break
+
+    def _run(self):
+        backoff = 1.0
+        failures = 0
+        while True:
+            entries = []
+            deadline = time.monotonic() + self.flush_interval
+            while len(entries) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0 or self._flush_requested or self._stop.is_set():
+                    break
+                try:
+                    entries.append(self._queue.get(timeout=min(timeout, 0.5)))
+                except queue.Empty:
+                    continue
+            # Drain whatever is left without waiting
+            while len(entries) < self.batch_size:
+                try:
+                    entries.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            for entry in entries:
+                line = (entry + "\n").encode("utf-8")
+                self._pending.append(line)
+                self._pending_bytes += len(line)
+            while self._pending_bytes > self.max_pending_bytes and len(self._pending) > 1:
+                self._pending_bytes -= len(self._pending.popleft())
+                self.dropped += 1
+            if self._pending:
+                try:
+                    self._write(b"".join(self._pending))
+                    self._pending.clear()
+                    self._pending_bytes = 0
+                    backoff = 1.0
+                    failures = 0
+                except Exception:
+                    # Keep the batch and retry later; new records keep queuing
+                    # (or are dropped) in the meantime
+                    self._current_size = None
+                    failures += 1
+                    if self._stop.is_set():
+                        if failures >= 3:
+                            break
+                        time.sleep(1.0)
+                    else:
+                        self._stop.wait(backoff)
+                    backoff = min(backoff * 2, 60.0)
+                    continue
+
+            if self._queue.empty() and not self._pending:
+                with self._flushed:
+                    self._flush_requested = False
+                    self._flushed.notify_all()
+                if self._stop.is_set():
+                    break
+
+    def flush(self, timeout=30.0):
+        """
+        Waits until every queued record has been written (not at all once
+        the writer thread has stopped).
+        """
+        if not self._thread.is_alive():
+            return
+        with self._flushed:
+            self._flush_requested = True
+            self._flushed.wait_for(lambda: not self._flush_requested, timeout=timeout)
+
+    def close(self):
+        self._stop.set()
+        self._thread.join(timeout=30.0)
+        super().close()
 
 
 class Singleton(type):
@@ -80,7 +322,7 @@ class Logger(metaclass=Singleton):
         self.logger = logging.getLogger("azureLogger")
         self.logger.setLevel(logging.DEBUG)
         azure_handler = AzureBlobStorageHandler(
-            connection_string_blob, logging_container_name, "test.log"
+            os.environ["CONNECTION_STRING_BLOB"], os.environ["LOGGING_CONTAINER_NAME"], "test.log"
         )
         azure_handler.setLevel(logging.DEBUG)
         formatter = logging.Formatter(
@@ -95,38 +337,166 @@ class Logger(metaclass=Singleton):
 
 def list_all_containers():
     container_list = list()
-    containers = blob_service_client.list_containers()
+    containers = get_blob_service_client().list_containers()
     for container in containers:
         if "genai" in container.name:
             container_list.append(container.name)
     return container_list
 
 
+def iter_blob_names(container_name, prefix=None, page_size=LIST_PAGE_SIZE, connection_string=None):
+    """
+    Yields the names of the blobs of a container (optionally only those
+    starting with `prefix`), one page of `page_size` at a time, without
+    building the whole listing in memory.
+    `connection_string` selects another account, e.g. "UseDevelopmentStorage=true" for Azurite.
+    """
+    container_client = get_blob_service_client(connection_string).get_container_client(container_name)
+    for page in container_client.list_blobs(name_starts_with=prefix, results_per_page=page_size).by_page():
+        for blob in page:
+            yield blob.name
+
+
 def list_all_files(container_name):
-    blob_list = blob_service_client.get_container_client(container_name).list_blobs()
-    blob_list_display = []
-    for blob in blob_list:
-        blob_list_display.append(blob.name)
-    return blob_list_display
+    return list(iter_blob_names(container_name))
+
+
+def delete_blobs(container_name, blob_names, connection_string=None):
+    """
+    Deletes blobs with the blob batch API, BATCH_DELETE_MAX_BLOBS per
+    request. `blob_names` can be any iterable (e.g. iter_blob_names).
+    Blobs that no longer exist are skipped.
+    Returns {blob_name: "status reason"} for the blobs that could not be deleted.
+    """
+    container_client = get_blob_service_client(connection_string).get_container_client(container_name)
+    failures = {}
+    batch = []
+    for name in blob_names:
+        batch.append(name)
+        if len(batch) == BATCH_DELETE_MAX_BLOBS:
+            failures.update(_delete_batch(container_client, batch))
+            batch = []
+    if batch:
+        failures.update(_delete_batch(container_client, batch))
+    return failures
+
+
+def _delete_batch(container_client, names):
+    # The sub-responses come back in the order of the names
+    responses = container_client.delete_blobs(*names, delete_snapshots="include", raise_on_any_failure=False)
+    return {
+        name: f"{response.status_code} {response.reason}"
+        for name, response in zip(names, responses)
+        if response.status_code not in (202, 404)
+    }
+
+
+def upload_blob(container_name, blob_name, data, overwrite=False, max_concurrency=MAX_CONCURRENCY, progress=None, connection_string=None):
+    """
+    Uploads bytes or a file object; large data is split in blocks of
+    TRANSFER_CONFIG["max_block_size"] sent over `max_concurrency`
+    connections. `progress(current_bytes, total_bytes)` is called as blocks complete.
+    """
+    blob_client = get_blob_service_client(connection_string, **TRANSFER_CONFIG).get_blob_client(container=container_name, blob=blob_name)
+    blob_client.upload_blob(data, overwrite=overwrite, max_concurrency=max_concurrency, progress_hook=progress)
+    return blob_client
+
+
+def download_blob(container_name, blob_name, stream, max_concurrency=MAX_CONCURRENCY, progress=None, connection_string=None):
+    """
+    Downloads a blob into a writable `stream`, in ranges of
+    TRANSFER_CONFIG["max_chunk_get_size"] fetched over `max_concurrency`
+    connections. `progress(current_bytes, total_bytes)` is called as ranges arrive.
+    Returns the number of bytes written.
+    """
+    blob_client = get_blob_service_client(connection_string, **TRANSFER_CONFIG).get_blob_client(container=container_name, blob=blob_name)
+    return blob_client.download_blob(max_concurrency=max_concurrency, progress_hook=progress).readinto(stream)
+
+
+def upload_files(container_name, paths, prefix="", overwrite=False, max_workers=MAX_CONCURRENCY, max_concurrency=MAX_CONCURRENCY, progress=None, connection_string=None):
+    """
+    Uploads local files in parallel (`max_workers` files at a time, each one
+    chunked as in upload_blob) to `prefix` + file name.
+    `progress(blob_name, current_bytes, total_bytes)` reports each file.
+    Returns {blob_name: exception} for the files that failed.
+    """
+
+    def upload(path):
+        blob_name = prefix + os.path.basename(path)
+        hook = (lambda current, total: progress(blob_name, current, total)) if progress else None
+        with open(path, "rb") as f:
+            upload_blob(container_name, blob_name, f, overwrite, max_concurrency, hook, connection_string)
+        return blob_name
+
+    return _run_parallel(upload, paths, max_workers, lambda path: prefix + os.path.basename(path))
+
+
+def download_files(container_name, directory, prefix=None, max_workers=MAX_CONCURRENCY, max_concurrency=MAX_CONCURRENCY, progress=None, connection_string=None):
+    """
+    Downloads every blob starting with `prefix` into `directory` (keeping
+    the "/" structure of the names), `max_workers` blobs at a time, each
+    one in parallel ranges as in download_blob.
+    `progress(blob_name, current_bytes, total_bytes)` reports each blob.
+    Returns {blob_name: exception} for the blobs that failed.
+    """
+
+    def download(blob_name):
+        path = os.path.join(directory, *blob_name.split("/"))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        hook = (lambda current, total: progress(blob_name, current, total)) if progress else None
+
+        def write(tmp_path):
+            with open(tmp_path, "wb") as f:
+                download_blob(container_name, blob_name, f, max_concurrency, hook, connection_string)
+
+        atomic_write(path, write)
+        return blob_name
+
+    return _run_parallel(download, iter_blob_names(container_name, prefix, connection_string=connection_string), max_workers, lambda name: name)
+
+
+def _run_parallel(func, items, max_workers, name_of):
+    """
+    Runs `func` over `items` with at most `max_workers` calls in flight
+    (items are consumed lazily, so a long listing is never held in memory).
+    Returns {name_of(item): exception} for the calls that failed.
+    """
+    failures = {}
+    items = iter(items)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        for item in items:
+            futures[executor.submit(func, item)] = item
+            if len(futures) >= max_workers * 2:
+                done = next(as_completed(futures))
+                _collect(done, futures, failures, name_of)
+        for done in as_completed(list(futures)):
+            _collect(done, futures, failures, name_of)
+    return failures
+
+
+def _collect(future, futures, failures, name_of):
+    item = futures.pop(future)
+    try:
+        future.result()
+    except Exception as e:
+        failures[name_of(item)] = e
 
 
 def upload_to_azure_storage(file,container_name):
-    blob_client = blob_service_client.get_blob_client(
-        container=container_name, blob=file.name
-    )
-    blob_client.upload_blob(file)
+    upload_blob(container_name, file.name, file)
     return True
 
 
 def delete_all_files(container_name):
-    container_client = blob_service_client.get_container_client(container_name)
-    blob_list = container_client.list_blobs()
-    for blob in blob_list:
-        container_client.delete_blob(blob.name)
+    failures = delete_blobs(container_name, iter_blob_names(container_name))
+    if failures:
+        details = ", ".join(f"{name} ({reason})" for name, reason in list(failures.items())[:5])
+        raise HttpResponseError(message=f"Could not delete {len(failures)} blobs from {container_name}: {details}")
     return True
 
 
 def create_new_container(container_name):
     genai_container = f"genai-{container_name}"
-    blob_service_client.create_container(genai_container)
+    get_blob_service_client().create_container(genai_container)
     return True
@@ -0,0 +1,223 @@
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import zlib
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+
+# The cache lives on local disk so every Streamlit worker on the node shares it
+CACHE_DIR = os.environ.get("SDMX_CACHE_DIR", os.path.join(tempfile.gettempdir(), "sdmx-explorer"))
+RESPONSE_CACHE_PATH = os.path.join(CACHE_DIR, "responses.sqlite")
+MAX_CACHE_BYTES = int(os.environ.get("SDMX_CACHE_MAX_MB", "512")) * 1024 * 1024
+
+# Seconds a cached response is served without asking the API again.
+# Flows that are updated often get a shorter TTL than the default.
+DEFAULT_TTL = 6 * 3600
+DATAFLOW_TTLS = {
+    "HUMANITARIAN_SITREP": 3600,
+}
+
+
+def normalize_url(url):
+    """
+    Returns a canonical form of an SDMX data URL so that equivalent queries
+    share a cache entry: host is lowercased, query parameters are sorted and
+    the codes inside each key dimension ("A+B" vs "B+A") are sorted.
+    """
+    parts = urlsplit(url)
+    path = parts.path
+    if "/data/" in path:
+        prefix, _, rest = path.partition("/data/")
+        segments = rest.split("/")
+        if len(segments) > 1:
+            segments[1] = ".".join("+".join(sorted(dim.split("+"))) for dim in segments[1].split("."))
+        path = prefix + "/data/" + "/".join(segments)
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), path, query, ""))
+
+
+def dataflow_from_url(url):
+    """
+    Extracts the dataflow id from ".../data/{agency},{dataflow_id},{version}/...".
+    """
+    path = urlsplit(url).path
+    if "/data/" not in path:
+        return ""
+    flow_ref = path.partition("/data/")[2].split("/")[0]
+    parts = flow_ref.split(",")
+    return parts[1] if len(parts) > 1 else parts[0]
+
+
+def atomic_write(path, write):
+    """
+    Writes a file with `write(tmp_path)` next to `path`, then moves it into
+    place in one step, so other threads and workers never read a partial
+    file. The temporary file is removed when `write` fails.
+    """
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def atomic_write_json(path, value):
+    def write(tmp_path):
+        with open(tmp_path, "w") as f:
+            json.dump(value, f)
+
+    atomic_write(path, write)
+
+
+class LruIndex:
+    """
+    SQLite table of entries keyed by normalized URL, with their size and
+    last access time, kept under `max_bytes` by dropping the least recently
+    used entries. `columns` declares the other columns of the table.
+    """
+
+    def __init__(self, path, table, columns, max_bytes):
+        self.path = path
+        self.table = table
+        self.max_bytes = max_bytes
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {table} (url TEXT PRIMARY KEY, {columns}, size INTEGER, last_access REAL)"
+            )
+            conn.execute(f"CREATE INDEX IF NOT EXISTS {table}_last_access ON {table} (last_access)")
+
+    def _connect(self):
+        # One short-lived connection per call: safe across threads and processes
+        return sqlite3.connect(self.path, timeout=30)
+
+    def ttl_for(self, url):
+        return DATAFLOW_TTLS.get(dataflow_from_url(url), DEFAULT_TTL)
+
+    def _lookup(self, key, columns):
+        """
+        Returns the `columns` of an entry (a tuple) and marks it as used, or None.
+        """
+        with self._connect() as conn:
+            row = conn.execute(f"SELECT {columns} FROM {self.table} WHERE url = ?", (key,)).fetchone()
+            if row is not None:
+                conn.execute(f"UPDATE {self.table} SET last_access = ? WHERE url = ?", (time.time(), key))
+        return row
+
+    def _insert(self, key, size, **values):
+        columns = ["url", "size", "last_access", *values]
+        with self._connect() as conn:
+            conn.execute(
+                f"INSERT OR REPLACE INTO {self.table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+                (key, size, time.time(), *values.values()),
+            )
+        self.evict()
+
+    def _update(self, key, **values):
+        with self._connect() as conn:
+            conn.execute(
+                f"UPDATE {self.table} SET {', '.join(f'{column} = ?' for column in values)} WHERE url = ?",
+                (*values.values(), key),
+            )
+
+    def _remove(self, conn, key):
+        conn.execute(f"DELETE FROM {self.table} WHERE url = ?", (key,))
+
+    def evict(self):
+        """
+        Drops the least recently used entries until the total size fits in max_bytes.
+        """
+        with self._connect() as conn:
+            total = conn.execute(f"SELECT COALESCE(SUM(size), 0) FROM {self.table}").fetchone()[0]
+            if total <= self.max_bytes:
+                return
+            rows = conn.execute(f"SELECT url, size FROM {self.table} ORDER BY last_access").fetchall()
+            for key, size in rows:
+                if total <= self.max_bytes:
+                    break
+                self._remove(conn, key)
+                total -= size
+
+
+class ResponseCache(LruIndex):
+    """
+    SQLite-backed cache of SDMX responses keyed by normalized URL.
+    Entries expire after a per-dataflow TTL and are then revalidated with
+    their ETag / Last-Modified. The file is kept under `max_bytes` by evicting
+    the least recently used entries.
+    """
+
+    def __init__(self, path=RESPONSE_CACHE_PATH, max_bytes=MAX_CACHE_BYTES):
+        super().__init__(
+            path,
+            "responses",
+            "dataflow TEXT, body BLOB, etag TEXT, last_modified TEXT, fetched_at REAL",
+            max_bytes,
+        )
+
+    def get(self, url):
+        """
+        Returns the cached entry for `url` as a dict (body, etag, last_modified,
+        fresh) or None when nothing is cached.
+        """
+        row = self._lookup(normalize_url(url), "body, etag, last_modified, fetched_at")
+        if row is None:
+            return None
+        body, etag, last_modified, fetched_at = row
+        return {
+            "body": zlib.decompress(body),
+            "etag": etag,
+            "last_modified": last_modified,
+            "fresh": time.time() - fetched_at < self.ttl_for(url),
+        }
+
+    def validators(self, entry):
+        """
+        Returns the conditional request headers for a stale cache entry.
+        """
+        headers = {}
+        if entry is None:
+            return headers
+        if entry["etag"]:
+            headers["If-None-Match"] = entry["etag"]
+        if entry["last_modified"]:
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def put(self, url, body, etag=None, last_modified=None):
+        compressed = zlib.compress(body)
+        self._insert(
+            normalize_url(url),
+            len(compressed),
+            dataflow=dataflow_from_url(url),
+            body=compressed,
+            etag=etag,
+            last_modified=last_modified,
+            fetched_at=time.time(),
+        )
+
+    def revalidated(self, url):
+        """
+        Marks an entry as fresh again after the API answered 304 Not Modified.
+        """
+        now = time.time()
+        self._update(normalize_url(url), fetched_at=now, last_access=now)
+
+
+_response_cache = None
+
+
+def get_response_cache():
+    global _response_cache
+    if _response_cache is None:
+        _response_cache = ResponseCache()
+    return _response_cache
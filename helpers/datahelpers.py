@@ -0,0 +1,194 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+import pandas as pd
+
+from helpers.metrichelpers import increment, span
+
+
+# Column names used by the page, and the names the different dataflows use for them
+COLUMN_SYNONYMS = {
+    "Geographical area": ["Country", "Geographic area", "Geo area", "Reference Areas", "Areas", "REGION", "Reference Area"],
+    "Indicator": ["Coverage Indicators", "Coverage indicators", "Demographic indicators", "Driver indicators", "Tier 2 indicators", "Situation Report Indicator"],
+}
+
+# Columns whose cardinality drives the default colour grouping and chart title
+GROUPING_COLUMNS = ["Geographical area", "Indicator", "Reference Areas"]
+
+# Aggregations offered by the chart builder (label -> pandas aggregation)
+AGGREGATIONS = {
+    "Mean": "mean",
+    "Median": "median",
+    "Min": "min",
+    "Max": "max",
+    "Count": "count",
+    "Last value": "last",
+}
+# Only these make sense when the Y column is not numeric
+NON_NUMERIC_AGGREGATIONS = ["count", "last"]
+
+# Memory budget of the aggregation cache, shared by every session of the process
+AGGREGATION_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# Sorted unique values are precomputed for columns with at most this many values,
+# larger ones (e.g. OBS_VALUE) are computed the first time they are asked for
+MAX_PRECOMPUTED_VALUES = 5000
+
+
+def normalize_columns(df):
+    """
+    Renames the synonyms of COLUMN_SYNONYMS to their standard column name.
+    """
+    rename_dict = {}
+    for standard, synonyms in COLUMN_SYNONYMS.items():
+        for col in synonyms:
+            if col in df.columns and col != standard:
+                rename_dict[col] = standard
+    if rename_dict:
+        df = df.rename(columns=rename_dict)
+    return df
+
+
+def data_version(df):
+    """
+    Returns a hash of the columns, dtypes and values of a frame: the same
+    data fetched again gets the same version, so the caches built on it
+    (aggregations, figures, exports) are reused.
+    """
+    digest = hashlib.sha1()
+    digest.update(repr([(str(col), str(dtype)) for col, dtype in df.dtypes.items()]).encode("utf-8"))
+    digest.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+    return digest.hexdigest()
+
+
+def describe_flow(df):
+    """
+    Precomputes the metadata the page needs about a fetched flow, so widget
+    changes read it instead of rescanning the data:
+    columns, cardinalities, sorted unique values and the default filter field.
+    `version` identifies this copy of the data for the caches built on it.
+    """
+    columns = df.columns.tolist()
+    nunique = {col: int(df[col].nunique()) for col in columns}
+    meta = {
+        "version": data_version(df),
+        "columns": columns,
+        "rows": len(df),
+        "nunique": nunique,
+        "unique": {},
+        "summaries": {},
+    }
+    for col in columns:
+        if nunique[col] <= MAX_PRECOMPUTED_VALUES:
+            meta["unique"][col] = sorted(df[col].dropna().unique(), key=lambda x: str(x))
+
+    # If "SEX" exists and has >1 unique value, prefill the filter with "SEX"
+    meta["default_filter_field"] = "SEX" if nunique.get("SEX", 0) > 1 else ""
+    return meta
+
+
+def unique_values(meta, df, col):
+    """
+    Returns the sorted unique values of a column, computing them once if they
+    were not precomputed.
+    """
+    if col not in meta["unique"]:
+        meta["unique"][col] = sorted(df[col].dropna().unique(), key=lambda x: str(x))
+    return meta["unique"][col]
+
+
+def filtered_summary(meta, df, field, value):
+    """
+    Returns the row count, the cardinality of the GROUPING_COLUMNS and the
+    first indicator of the rows where `field == value` (all rows when field
+    is ""). The summaries of every value of a field are computed in one
+    groupby the first time the field is used, then read from the metadata.
+    """
+    group_cols = [col for col in GROUPING_COLUMNS if col in meta["columns"]]
+    if field == "":
+        summary = {"rows": meta["rows"]}
+        for col in group_cols:
+            summary[col] = meta["nunique"][col]
+        if "Indicator" in group_cols:
+            summary["first_indicator"] = df["Indicator"].iloc[0] if meta["rows"] else None
+        return summary
+
+    if field not in meta["summaries"]:
+        grouped = df.groupby(field, observed=True, sort=False)
+        table = pd.DataFrame({"rows": grouped.size()})
+        for col in group_cols:
+            # Within a value of the field itself there is exactly one value
+            table[col] = 1 if col == field else grouped[col].nunique()
+        if "Indicator" in group_cols:
+            table["first_indicator"] = table.index if field == "Indicator" else grouped["Indicator"].first()
+        meta["summaries"][field] = table.to_dict(orient="index")
+
+    if value in meta["summaries"][field]:
+        return meta["summaries"][field][value]
+    summary = {"rows": 0, "first_indicator": None}
+    for col in group_cols:
+        summary[col] = 0
+    return summary
+
+
+class AggregationCache:
+    """
+    LRU cache of aggregated frames, bounded by their memory usage.
+    """
+
+    def __init__(self, max_bytes=AGGREGATION_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return self._entries[key][0]
+
+    def put(self, key, table):
+        size = int(table.memory_usage(deep=True).sum())
+        with self._lock:
+            if key in self._entries:
+                self.size -= self._entries.pop(key)[1]
+            self._entries[key] = (table, size)
+            self.size += size
+            while self.size > self.max_bytes and len(self._entries) > 1:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.size -= evicted_size
+
+
+_aggregation_cache = AggregationCache()
+
+
+def aggregate(meta, df, filter_field, filter_value, x, group, y, how="Mean"):
+    """
+    Returns `y` aggregated by `x` (and `group` unless it is None) over the
+    rows where `filter_field == filter_value` (all rows when filter_field is "").
+    Every aggregation of AGGREGATIONS is computed in the same groupby and
+    cached under the flow's data version, so switching the aggregation or
+    coming back to an earlier chart reads the cache, and charts of other
+    flows are never recomputed.
+    """
+    by = [x] if group is None else [x, group]
+    key = (meta["version"], filter_field, filter_value, x, group, y)
+    table = _aggregation_cache.get(key)
+    increment("aggregation_cache_total", result="hit" if table is not None else "miss")
+    if table is None:
+        with span("aggregate", rows=meta["rows"]):
+            data = df if filter_field == "" else df[df[filter_field] == filter_value]
+            if pd.api.types.is_numeric_dtype(data[y]):
+                funcs = list(AGGREGATIONS.values())
+            else:
+                funcs = NON_NUMERIC_AGGREGATIONS
+            table = data.groupby(by, observed=True)[y].agg(funcs).reset_index()
+        _aggregation_cache.put(key, table)
+
+    func = AGGREGATIONS[how]
+    if func not in table.columns:
+        raise ValueError(f"'{how}' cannot be computed on the non-numeric column '{y}'")
+    return table[by + [func]].rename(columns={func: y})
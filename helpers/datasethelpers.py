@@ -0,0 +1,225 @@
+import json
+import os
+import threading
+import time
+import weakref
+from collections import Counter, OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+
+from helpers.cachehelpers import DATAFLOW_TTLS, DEFAULT_TTL
+from helpers.metrichelpers import bind_run, increment
+from helpers.sdmxhelpers import MAX_CONCURRENT_REQUESTS, fetch_flow
+
+
+# Memory the fetched frames of all sessions may use together
+DATASET_CACHE_MAX_BYTES = int(os.environ.get("SDMX_DATASET_CACHE_MB", "1024")) * 1024 * 1024
+
+# Partial or stale results (see fetch_flow) are kept this long only, then fetched again
+INCOMPLETE_DATASET_TTL = 60
+
+# Expired datasets still referenced by a session are fetched again here, off the script thread
+_refresh_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="dataset-refresh")
+
+
+def dataset_key(flow, query):
+    """
+    Returns the canonical key of a query: the order of the selected codes
+    does not matter.
+    """
+    canonical = {k: sorted(v) if isinstance(v, list) else v for k, v in query.items()}
+    return json.dumps([flow, canonical], sort_keys=True, default=str)
+
+
+class DatasetStore:
+    """
+    Fetched flows shared by every session of the process, keyed by canonical
+    query. Identical queries arriving while one is being fetched wait for
+    that fetch instead of starting their own. Sessions keep DatasetHandles,
+    which count as references: when the frames outgrow `max_bytes`, the
+    least recently used unreferenced datasets are dropped first, then
+    referenced ones (their handles fetch them again, from the local caches,
+    when next read). Handles are served an expired dataset while it is
+    refreshed in the background.
+    """
+
+    def __init__(self, max_bytes=DATASET_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._loading = {}
+        self._refs = Counter()
+        self._lock = threading.Lock()
+
+    def _insert(self, key, result, ttl):
+        size = int(result["data"].memory_usage(deep=True).sum())
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.size -= old["size"]
+        # Kept no longer than the cached responses it was built from
+        self._entries[key] = {"result": result, "size": size, "expires": time.time() + ttl}
+        self.size += size
+        self._evict(keep=key)
+
+    def _evict(self, keep):
+        for referenced in (False, True):
+            for key in list(self._entries):
+                if self.size <= self.max_bytes:
+                    return
+                if key == keep or (self._refs[key] > 0) != referenced:
+                    continue
+                self.size -= self._entries.pop(key)["size"]
+                increment("dataset_store_evictions_total", referenced=str(referenced).lower())
+        # Only the dataset just inserted is left, and it alone is over budget
+        increment("dataset_store_over_budget_total")
+
+    def get(self, flow, query, loader=fetch_flow, allow_stale=False):
+        """
+        Returns the fetch result of a query ({"flow", "data", "meta",
+        "messages", "status"}), from memory, from a fetch already in flight, or by
+        calling `loader(flow, query)`. Failed fetches are not kept, and
+        partial or stale ones only for INCOMPLETE_DATASET_TTL seconds, their
+        errors repeated on every hit. With allow_stale=True an expired dataset is returned as is and
+        fetched again in the background.
+        """
+        key = dataset_key(flow, query)
+        with self._lock:
+            entry = self._entries.get(key)
+            now = time.time()
+            if entry is not None and (now < entry["expires"] or allow_stale):
+                self._entries.move_to_end(key)
+                messages = [("write", f"Fetching data for dataflow: {flow}"), ("write", "Served from memory, shared with other sessions")]
+                messages += [message for message in entry["result"]["messages"] if message[0] == "error"]
+                if now < entry["expires"]:
+                    increment("dataset_store_total", result="hit")
+                else:
+                    increment("dataset_store_total", result="stale")
+                    if key not in self._loading:
+                        self._loading[key] = Future()
+                        _refresh_executor.submit(self._load, key, self._loading[key], flow, query, loader)
+                return {**entry["result"], "messages": messages}
+            future = self._loading.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._loading[key] = future
+
+        if not leader:
+            increment("dataset_store_total", result="coalesced")
+            result = future.result()
+            return {**result, "messages": result["messages"] + [("write", "Joined an identical fetch already in progress")]}
+
+        increment("dataset_store_total", result="miss")
+        return self._load(key, future, flow, query, loader)
+
+    def _load(self, key, future, flow, query, loader):
+        try:
+            result = loader(flow, query)
+        except BaseException as e:
+            with self._lock:
+                del self._loading[key]
+            future.set_exception(e)
+            raise
+        with self._lock:
+            del self._loading[key]
+            if result["data"] is not None:
+                ttl = DATAFLOW_TTLS.get(query.get("dataflow_id"), DEFAULT_TTL)
+                if not result["status"]["complete"]:
+                    ttl = min(ttl, INCOMPLETE_DATASET_TTL)
+                self._insert(key, result, ttl)
+        future.set_result(result)
+        return result
+
+    def acquire(self, flow, query, loader=fetch_flow):
+        """
+        Fetches a query (see get) and returns (DatasetHandle or None when
+        there is no data, messages).
+        """
+        result = self.get(flow, query, loader)
+        if result["data"] is None:
+            return None, result["messages"]
+        return DatasetHandle(self, flow, query, loader), result["messages"]
+
+    def _add_ref(self, key):
+        with self._lock:
+            self._refs[key] += 1
+
+    def _release(self, key):
+        with self._lock:
+            self._refs[key] -= 1
+            if self._refs[key] <= 0:
+                del self._refs[key]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "datasets": len(self._entries),
+                "bytes": self.size,
+                "referenced": sum(1 for key in self._entries if self._refs[key] > 0),
+                "in_flight": len(self._loading),
+            }
+
+
+class DatasetHandle:
+    """
+    A session's reference to a dataset of the store. It holds the query, not
+    the frame: `data` and `meta` are looked up in the store on each run
+    (an expired dataset is served while it is refreshed in the background).
+    The reference is dropped by release() or when the handle is garbage
+    collected with its session.
+    """
+
+    def __init__(self, store, flow, query, loader=fetch_flow):
+        self.store = store
+        self.flow = flow
+        self.query = query
+        self.loader = loader
+        self.key = dataset_key(flow, query)
+        store._add_ref(self.key)
+        self._finalizer = weakref.finalize(self, store._release, self.key)
+
+    @property
+    def result(self):
+        return self.store.get(self.flow, self.query, self.loader, allow_stale=True)
+
+    @property
+    def data(self):
+        return self.result["data"]
+
+    @property
+    def meta(self):
+        return self.result["meta"]
+
+    def release(self):
+        self._finalizer()
+
+
+_dataset_store = None
+_dataset_store_lock = threading.Lock()
+
+
+def get_dataset_store():
+    global _dataset_store
+    with _dataset_store_lock:
+        if _dataset_store is None:
+            _dataset_store = DatasetStore()
+    return _dataset_store
+
+
+def fetch_shared_flows(jobs, max_workers=MAX_CONCURRENT_REQUESTS):
+    """
+    Like sdmxhelpers.fetch_flows, through the shared dataset store: yields
+    {"flow", "handle", "messages"} for each flow as soon as it is available,
+    handle being None when the flow returned no data.
+    """
+    if not jobs:
+        return
+    store = get_dataset_store()
+
+    def acquire(flow, query):
+        handle, messages = store.acquire(flow, query)
+        return {"flow": flow, "handle": handle, "messages": messages}
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(jobs))) as executor:
+        futures = [executor.submit(bind_run(acquire), flow, query) for flow, query in jobs.items()]
+        for future in as_completed(futures):
+            yield future.result()
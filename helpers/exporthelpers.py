@@ -0,0 +1,139 @@
+import hashlib
+import os
+import zipfile
+
+from helpers.cachehelpers import CACHE_DIR, atomic_write
+
+
+# Exports are written on request to local disk, once per data version and format
+EXPORT_DIR = os.path.join(CACHE_DIR, "exports")
+EXPORT_MAX_BYTES = int(os.environ.get("SDMX_EXPORT_MAX_MB", "1024")) * 1024 * 1024
+# Rows written at a time by the CSV exports
+EXPORT_CHUNK_ROWS = 50_000
+
+# Format label -> (file extension, MIME type)
+EXPORT_FORMATS = {
+    "CSV": (".csv", "text/csv"),
+    "CSV (gzip)": (".csv.gz", "application/gzip"),
+    "Parquet": (".parquet", "application/vnd.apache.parquet"),
+}
+
+
+def _export_path(key, export_format, extension=None):
+    extension = extension or EXPORT_FORMATS[export_format][0]
+    return os.path.join(EXPORT_DIR, f"{key}{extension}")
+
+
+def _write_atomically(path, write):
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    atomic_write(path, write)
+
+
+def _prune_exports(keep):
+    """
+    Deletes the least recently used exports until the export directory fits
+    in EXPORT_MAX_BYTES, never the paths of `keep` (the files being
+    returned to the caller), even when they alone are over budget.
+    """
+    keep = set(keep)
+    files = []
+    for name in os.listdir(EXPORT_DIR):
+        path = os.path.join(EXPORT_DIR, name)
+        if name.endswith(".tmp") or path in keep:
+            continue
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        files.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in files) + sum(os.path.getsize(path) for path in keep if os.path.exists(path))
+    for _, size, path in sorted(files):
+        if total <= EXPORT_MAX_BYTES:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
+
+
+def existing_export(version, export_format):
+    """
+    Returns the path of an export already written for this data version, or None.
+    """
+    return _existing(_export_path(version, export_format))
+
+
+def _existing(path):
+    # Marked as recently used, so pruning drops it last
+    try:
+        os.utime(path)
+    except OSError:
+        return None
+    return path
+
+
+def export_flow(df, version, export_format):
+    """
+    Writes one flow in the given format and returns the file path.
+    CSV exports are written in chunks of EXPORT_CHUNK_ROWS rows straight to
+    disk, so the whole file never sits in memory as one bytes object.
+    """
+    path = _write_export(df, version, export_format)
+    _prune_exports(keep=[path])
+    return path
+
+
+def _write_export(df, version, export_format):
+    path = existing_export(version, export_format)
+    if path is not None:
+        return path
+    path = _export_path(version, export_format)
+    if export_format == "CSV":
+        _write_atomically(path, lambda p: df.to_csv(p, index=False, chunksize=EXPORT_CHUNK_ROWS))
+    elif export_format == "CSV (gzip)":
+        _write_atomically(path, lambda p: df.to_csv(p, index=False, chunksize=EXPORT_CHUNK_ROWS, compression="gzip"))
+    elif export_format == "Parquet":
+        _write_atomically(path, lambda p: df.to_parquet(p, index=False))
+    else:
+        raise ValueError(f"Unsupported export format: {export_format}")
+    return path
+
+
+def archive_key(versions, export_format):
+    digest = hashlib.sha1("|".join(sorted(versions)).encode("utf-8")).hexdigest()
+    return f"archive-{digest}-{EXPORT_FORMATS[export_format][0].strip('.').replace('.', '-')}"
+
+
+def existing_archive(versions, export_format):
+    return _existing(_export_path(archive_key(versions, export_format), export_format, ".zip"))
+
+
+def export_archive(flows, export_format):
+    """
+    Writes a single zip archive holding every flow in the given format and
+    returns its path. `flows` maps each flow name to (DataFrame, version);
+    the per-flow exports are reused, and copied into the archive file by file.
+    """
+    versions = [version for _, version in flows.values()]
+    path = existing_archive(versions, export_format)
+    if path is not None:
+        return path
+    path = _export_path(archive_key(versions, export_format), export_format, ".zip")
+    extension = EXPORT_FORMATS[export_format][0]
+    # Nothing is pruned until the members are in the archive
+    member_paths = {
+        flow: _write_export(df, version, export_format) for flow, (df, version) in flows.items()
+    }
+    # Plain CSV compresses well, the other formats are compressed already
+    compression = zipfile.ZIP_DEFLATED if export_format == "CSV" else zipfile.ZIP_STORED
+
+    def write(tmp_path):
+        with zipfile.ZipFile(tmp_path, "w", compression=compression, allowZip64=True) as archive:
+            for flow, member_path in member_paths.items():
+                safe_name = "".join(c if c.isalnum() or c in " -_" else "_" for c in str(flow))
+                archive.write(member_path, arcname=f"{safe_name}_data{extension}")
+
+    _write_atomically(path, write)
+    _prune_exports(keep=[path, *member_paths.values()])
+    return path
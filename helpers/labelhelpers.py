@@ -0,0 +1,126 @@
+import json
+import os
+import re
+import xml.etree.ElementTree as ET
+
+import numpy as np
+import pandas as pd
+
+from helpers.cachehelpers import CACHE_DIR, atomic_write_json
+
+
+# Label layouts learned per dataflow from labelled responses
+LABEL_CACHE_DIR = os.path.join(CACHE_DIR, "labels")
+
+# SDMX component ids (REF_AREA, UNIT_MEASURE, ...); label columns carry the concept name instead
+_ID_PATTERN = re.compile(r"^[A-Z][A-Z0-9_]*$")
+
+# Columns added by the parser rather than sent by the API
+_ADDED_COLUMNS = ["dataflow"]
+
+
+def _layout_path(query):
+    return os.path.join(LABEL_CACHE_DIR, f"{query['agency']}_{query['dataflow_id']}_{query.get('version', '1.0')}.json")
+
+
+def load_label_layout(query):
+    """
+    Returns the label layout learned for the dataflow of a query, or None
+    when no labelled response has been seen yet. A layout with "lean" False
+    belongs to a dataflow whose columns did not match it once: it is always
+    fetched with labels.
+    """
+    try:
+        with open(_layout_path(query)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save_label_layout(query, layout):
+    os.makedirs(LABEL_CACHE_DIR, exist_ok=True)
+    atomic_write_json(_layout_path(query), layout)
+
+
+def disable_lean(query, layout):
+    save_label_layout(query, {**layout, "lean": False})
+
+
+def learn_label_layout(df, layout=None):
+    """
+    Learns from a labels=both frame which column holds the label of each code
+    column (the column right after it) and the label of every code seen,
+    merged into `layout` when given. Returns
+    {"columns": [...], "labels": {code column: {"column": label column, "values": {code: label}}}}
+    """
+    columns = [col for col in df.columns if col not in _ADDED_COLUMNS]
+    known = layout["labels"] if layout and layout.get("columns") == columns else {}
+    labels = {}
+    for code_col, label_col in zip(columns, columns[1:]):
+        if not _ID_PATTERN.match(str(code_col)) or _ID_PATTERN.match(str(label_col)):
+            continue
+        pairs = df[[code_col, label_col]].drop_duplicates().dropna()
+        values = dict(known.get(code_col, {}).get("values", {}))
+        values.update({str(code): label for code, label in zip(pairs[code_col].tolist(), pairs[label_col].tolist())})
+        labels[code_col] = {"column": label_col, "values": values}
+    return {"columns": columns, "labels": labels}
+
+
+def layout_matches(df, layout):
+    """
+    Whether a frame fetched with labels=id has the code columns of the layout, in order.
+    """
+    label_columns = {labels["column"] for labels in layout["labels"].values()}
+    expected = [col for col in layout["columns"] if col not in label_columns]
+    return [col for col in df.columns if col not in _ADDED_COLUMNS] == expected
+
+
+def parse_codelist(xml_bytes):
+    """
+    Parses an SDMX-ML codelist message into {code: name}, taking the English
+    name when there are several languages.
+    """
+    root = ET.fromstring(xml_bytes)
+    labels = {}
+    for code in root.iter():
+        if not code.tag.endswith("}Code"):
+            continue
+        names = {}
+        for child in code:
+            if child.tag.endswith("}Name"):
+                names[child.get("{http://www.w3.org/XML/1998/namespace}lang", "en")] = child.text or ""
+        if names:
+            labels[code.get("id")] = names.get("en", next(iter(names.values())))
+    return labels
+
+
+def attach_labels(df, layout, codelist_for=None):
+    """
+    Rebuilds the labels=both columns of a frame fetched with labels=id: a
+    categorical label column is inserted after each code column, so every
+    label string is stored once. Codes missing from the layout are looked up
+    with `codelist_for(code column)` ({code: label} or None).
+    Returns None when the frame does not match the layout or a code has no
+    label, so the caller can fetch the labels from the API instead.
+    """
+    if not layout_matches(df, layout):
+        return None
+
+    data = {}
+    for col in df.columns:
+        data[col] = df[col]
+        if col not in layout["labels"]:
+            continue
+        values = layout["labels"][col]["values"]
+        codes = df[col] if isinstance(df[col].dtype, pd.CategoricalDtype) else df[col].astype("category")
+        code_labels = [values.get(str(code)) for code in codes.cat.categories]
+        if None in code_labels and codelist_for is not None:
+            codelist = codelist_for(col) or {}
+            code_labels = [label if label is not None else codelist.get(str(code)) for code, label in zip(codes.cat.categories, code_labels)]
+        if None in code_labels:
+            return None
+        # Map each code category to the position of its label, then relabel the rows in one take
+        label_categories = pd.Index(pd.unique(np.array(code_labels, dtype=object)))
+        positions = np.append(label_categories.get_indexer(code_labels), -1)
+        data[layout["labels"][col]["column"]] = pd.Categorical.from_codes(positions[codes.cat.codes.to_numpy()], categories=label_categories)
+    return pd.DataFrame(data, index=df.index)
@@ -0,0 +1,224 @@
+import logging
+import os
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+
+from helpers.azhelpers import get_blob_service_client
+from helpers.cachehelpers import CACHE_DIR, atomic_write
+from helpers.metrichelpers import increment, span
+from helpers.searchhelpers import IndicatorSearchIndex
+
+
+# Parquet snapshots of the mapping file, one per blob ETag, shared by all workers on the node
+MAPPING_CACHE_DIR = os.path.join(CACHE_DIR, "mapping")
+
+# Last ETag seen per mapping blob, used while the blob service cannot be reached
+_last_etags = {}
+
+
+def _mapping_blob_client(connection_string, container_name, blob_name):
+    return get_blob_service_client(connection_string).get_container_client(container_name).get_blob_client(blob_name)
+
+
+def _newest_snapshot_etag():
+    try:
+        snapshots = [entry for entry in os.scandir(MAPPING_CACHE_DIR) if entry.name.endswith(".parquet")]
+    except OSError:
+        return None
+    if not snapshots:
+        return None
+    return max(snapshots, key=lambda entry: entry.stat().st_mtime).name[: -len(".parquet")]
+
+
+def get_mapping_etag(connection_string, container_name, blob_name, fallback=False):
+    """
+    Returns the current ETag of the mapping blob (a metadata request, the
+    file itself is not downloaded).
+    With fallback=True, a failed request returns the last ETag seen by this
+    process, or else the one of the newest Parquet snapshot on disk, so the
+    cached catalogue keeps being served; it raises only when there is neither.
+    """
+    key = (container_name, blob_name)
+    try:
+        etag = _mapping_blob_client(connection_string, container_name, blob_name).get_blob_properties().etag
+    except Exception as e:
+        if not fallback:
+            raise
+        etag = _last_etags.get(key) or _newest_snapshot_etag()
+        if etag is None:
+            raise
+        increment("mapping_etag_fallbacks_total")
+        logging.getLogger(__name__).warning("Could not check the mapping blob (%s), using version %s", e, etag)
+        return etag
+    _last_etags[key] = etag
+    return etag
+
+
+def _snapshot_path(etag):
+    safe_etag = "".join(c for c in str(etag) if c.isalnum())
+    return os.path.join(MAPPING_CACHE_DIR, f"{safe_etag}.parquet")
+
+
+def load_mapping_catalogue(connection_string, container_name, blob_name, etag):
+    """
+    Returns the MappingCatalogue for the given version of the mapping blob.
+    A worker that finds a Parquet snapshot for that ETag loads it instead of
+    downloading and parsing the CSV again.
+    """
+    path = _snapshot_path(etag)
+    if os.path.exists(path):
+        with span("mapping_load", source="parquet"):
+            return MappingCatalogue(pd.read_parquet(path), etag)
+
+    with span("mapping_download"):
+        download_stream = _mapping_blob_client(connection_string, container_name, blob_name).download_blob()
+        csv_bytes = download_stream.readall()
+    increment("mapping_bytes_total", len(csv_bytes))
+    with span("mapping_load", source="csv"):
+        df_mapping = pd.read_csv(BytesIO(csv_bytes))
+        # The text columns repeat a handful of values over many rows
+        for col in df_mapping.columns:
+            if df_mapping[col].dtype == object or pd.api.types.is_string_dtype(df_mapping[col]):
+                df_mapping[col] = df_mapping[col].astype("category")
+
+    # Store under the ETag of what was actually downloaded, in case the blob changed in between
+    etag = download_stream.properties.etag or etag
+    path = _snapshot_path(etag)
+    os.makedirs(MAPPING_CACHE_DIR, exist_ok=True)
+    atomic_write(path, lambda tmp_path: df_mapping.to_parquet(tmp_path, index=False))
+    with span("mapping_index"):
+        return MappingCatalogue(df_mapping, etag)
+
+
+def _sorted_values(values):
+    return sorted((v for v in values if pd.notna(v)), key=lambda x: str(x))
+
+
+class MappingCatalogue:
+    """
+    The mapping file with prebuilt lookup indexes for the widget cascade.
+    Rows are indexed as country -> level -> category -> indicator -> row
+    positions, so each step of the cascade only walks the selected branches
+    instead of scanning the whole DataFrame.
+    Level is the value of the "national" column (None when the column is
+    missing), category is None when the "category" column is missing.
+    Indicators are also searchable by name, ID, category and dataflow name.
+    """
+
+    def __init__(self, df, etag=None):
+        self.df = df.reset_index(drop=True)
+        self.etag = etag
+        self.has_national = "national" in self.df.columns
+        self.has_category = "category" in self.df.columns
+
+        level = self.df["national"] if self.has_national else pd.Series(None, index=self.df.index, dtype=object)
+        category = self.df["category"] if self.has_category else pd.Series(None, index=self.df.index, dtype=object)
+        key_columns = [self.df["country"], level, category, self.df["indicator"]]
+
+        # Factorize the key columns and sort the rows by key, so each
+        # (country, level, category, indicator) is one contiguous run
+        codes, values = [], []
+        for col in key_columns:
+            col_codes, col_values = pd.factorize(col)
+            codes.append(col_codes)
+            values.append(list(col_values) + [None])  # code -1 (missing) maps to None
+        keys = np.stack(codes, axis=1)
+        order = np.lexsort(keys.T[::-1])
+        sorted_keys = keys[order]
+        boundaries = np.flatnonzero(np.any(sorted_keys[1:] != sorted_keys[:-1], axis=1)) + 1
+        starts = np.concatenate(([0], boundaries)) if len(order) else np.array([], dtype=int)
+        ends = np.concatenate((boundaries, [len(order)])) if len(order) else np.array([], dtype=int)
+
+        self.tree = {}
+        country_values, level_values, category_values, indicator_values = values
+        for start, end, (c, l, g, i) in zip(starts.tolist(), ends.tolist(), sorted_keys[starts].tolist()):
+            country = country_values[c]
+            if country is None:
+                continue
+            # lexsort is stable, so the positions of a run are already in row order
+            self.tree.setdefault(country, {}).setdefault(level_values[l], {}).setdefault(category_values[g], {})[indicator_values[i]] = order[start:end]
+
+        self.countries = _sorted_values(self.tree)
+        with span("mapping_search_index"):
+            self.search_index = IndicatorSearchIndex(self.df)
+
+    def _branches(self, countries, level):
+        for country in countries:
+            levels = self.tree.get(country, {})
+            if level is None:
+                yield from levels.values()
+            elif level in levels:
+                yield levels[level]
+
+    def has_rows(self, countries, level=None):
+        return any(True for _ in self._branches(countries, level))
+
+    def categories(self, countries, level=None):
+        values = set()
+        for branch in self._branches(countries, level):
+            values.update(branch)
+        return _sorted_values(values)
+
+    def indicators(self, countries, level=None, categories=None):
+        values = set()
+        for branch in self._branches(countries, level):
+            for cat, indicators in branch.items():
+                if not categories or cat in categories:
+                    values.update(indicators)
+        return _sorted_values(values)
+
+    def search_indicators(self, text, limit=None):
+        """
+        Returns the indicators matching `text` across all countries and
+        categories, best match first.
+        """
+        return self.search_index.search(text, limit)
+
+    def indicator_categories(self, indicator):
+        return self.search_index.categories.get(indicator, [])
+
+    def rows(self, countries, level=None, categories=None, indicators=None):
+        """
+        Returns the mapping rows matching the selection (None means no filter).
+        """
+        positions = []
+        for branch in self._branches(countries, level):
+            for cat, by_indicator in branch.items():
+                if categories and cat not in categories:
+                    continue
+                for indicator, rows in by_indicator.items():
+                    if indicators is None or indicator in indicators:
+                        positions.append(rows)
+        if not positions:
+            return self.df.iloc[0:0]
+        return self.df.iloc[np.sort(np.concatenate(positions))]
+
+
+def build_queries(df_candidates, flows, countries, indicators, national=True):
+    """
+    Returns the SDMX query of each dataflow for a selection, from its mapping
+    rows (MappingCatalogue.rows), and the flows with no mapping rows.
+    A query holds agency, dataflow_id, geography_ids, geographies,
+    indicator_ids and national; see sdmxhelpers.fetch_flows.
+    """
+    queries = {}
+    missing = []
+    for flow in flows:
+        df_flow = df_candidates[df_candidates["dataflow_name"] == flow]
+        if df_flow.empty:
+            missing.append(flow)
+            continue
+        first_row = df_flow.iloc[0]
+        df_geo = df_flow[df_flow["country"].isin(countries)]
+        queries[flow] = {
+            "agency": first_row["agency"],
+            "dataflow_id": first_row["dataflow_id"],
+            # Subnational queries select their areas by code, not by geography id
+            "geography_ids": df_geo["geography_id"].unique().tolist() if national else [],
+            "geographies": df_geo["geography"].unique().tolist(),
+            "indicator_ids": df_flow[df_flow["indicator"].isin(indicators)]["indicator_id"].unique().tolist(),
+            "national": national,
+        }
+    return queries, missing
@@ -0,0 +1,179 @@
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from helpers.cachehelpers import atomic_write
+
+
+METRIC_PREFIX = "sdmx_explorer_"
+# When set, the Prometheus text is written to this file after each run
+# (for the node_exporter textfile collector)
+METRICS_FILE = os.environ.get("SDMX_METRICS_FILE")
+# When "1", the breakdown of each run is sent as a JSON event through the azure Logger
+METRICS_TO_LOG = os.environ.get("SDMX_METRICS_TO_LOG") == "1"
+
+_lock = threading.Lock()
+_counters = defaultdict(int)
+_timings = defaultdict(lambda: [0, 0.0])
+_current_run = contextvars.ContextVar("sdmx_explorer_run", default=None)
+
+
+class RunTrace:
+    """
+    The spans and counters recorded during one run of the page.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.spans = []
+        self.counters = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def add_span(self, stage, seconds, labels):
+        with self._lock:
+            self.spans.append({"stage": stage, "seconds": seconds, **labels})
+
+    def add_count(self, name, value, labels):
+        with self._lock:
+            self.counters[_series_name(name, labels)] += value
+
+    def summary(self):
+        """
+        Returns the total time, number of calls and labels seen per stage.
+        """
+        stages = {}
+        with self._lock:
+            for event in self.spans:
+                stage = stages.setdefault(event["stage"], {"stage": event["stage"], "calls": 0, "seconds": 0.0})
+                stage["calls"] += 1
+                stage["seconds"] += event["seconds"]
+        return sorted(stages.values(), key=lambda s: -s["seconds"])
+
+
+def _series_name(name, labels):
+    if not labels:
+        return METRIC_PREFIX + name
+    label_text = ",".join(f'{k}="{v}"' for k, v in sorted(labels.items()))
+    return f"{METRIC_PREFIX}{name}{{{label_text}}}"
+
+
+def start_run():
+    """
+    Starts recording a new run in the current context and returns its trace.
+    """
+    trace = RunTrace()
+    _current_run.set(trace)
+    return trace
+
+
+def current_run():
+    return _current_run.get()
+
+
+def bind_run(func):
+    """
+    Wraps `func` so it records into the current run when called from a worker
+    thread (thread pools do not carry context variables over).
+    """
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.copy().run(func, *args, **kwargs)
+
+
+@contextmanager
+def span(stage, **labels):
+    """
+    Times a block as one stage of the run, e.g. `with span("parse", flow=flow):`.
+    Only the stage name is used as a Prometheus label, the other labels are
+    kept in the run trace.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        with _lock:
+            timing = _timings[stage]
+            timing[0] += 1
+            timing[1] += seconds
+        trace = _current_run.get()
+        if trace is not None:
+            trace.add_span(stage, seconds, labels)
+
+
+def increment(name, value=1, **labels):
+    """
+    Adds `value` to a counter, e.g. increment("response_cache_total", result="hit").
+    """
+    series = _series_name(name, labels)
+    with _lock:
+        _counters[series] += value
+    trace = _current_run.get()
+    if trace is not None:
+        trace.add_count(name, value, labels)
+
+
+def _format_value(value):
+    # Exact values: a rounded counter would move in steps and break rate()
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+
+def prometheus_text():
+    """
+    Returns every counter and stage timing of the process in the Prometheus
+    text exposition format.
+    """
+    lines = []
+    with _lock:
+        counters = dict(_counters)
+        timings = {stage: list(timing) for stage, timing in _timings.items()}
+    seen = set()
+    for series in sorted(counters):
+        name = series.split("{", 1)[0]
+        if name not in seen:
+            lines.append(f"# TYPE {name} counter")
+            seen.add(name)
+        lines.append(f"{series} {_format_value(counters[series])}")
+    if timings:
+        name = METRIC_PREFIX + "stage_seconds"
+        lines.append(f"# TYPE {name} summary")
+        for stage in sorted(timings):
+            count, total = timings[stage]
+            lines.append(f'{name}_count{{stage="{stage}"}} {count}')
+            lines.append(f'{name}_sum{{stage="{stage}"}} {total:.6f}')
+    return "\n".join(lines) + "\n"
+
+
+def finish_run(trace):
+    """
+    Exports a finished run: writes METRICS_FILE and sends a structured event
+    through the azure Logger, when they are enabled.
+    """
+    if METRICS_FILE:
+        text = prometheus_text()
+
+        def write(tmp_path):
+            with open(tmp_path, "w") as f:
+                f.write(text)
+
+        atomic_write(METRICS_FILE, write)
+    if METRICS_TO_LOG:
+        event = {
+            "event": "run_metrics",
+            "seconds": time.time() - trace.started,
+            "stages": trace.summary(),
+            "counters": dict(trace.counters),
+        }
+        try:
+            # Imported here: the azure helpers need their own settings and clients
+            from helpers.azhelpers import Logger
+
+            Logger().get_logger().info(json.dumps(event))
+        except Exception as e:
+            logging.getLogger(__name__).warning("Could not log run metrics: %s", e)
@@ -0,0 +1,155 @@
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+import plotly.express as px
+
+from helpers.metrichelpers import increment, span
+
+
+# Above this many points a chart switches to WebGL traces, and line/scatter
+# charts are downsampled to about MAX_PLOT_POINTS points in total
+LARGE_FIGURE_POINTS = 5000
+MAX_PLOT_POINTS = 4000
+MIN_POINTS_PER_GROUP = 50
+
+# Built figures kept, shared by every session of the process: at most
+# FIGURE_CACHE_ENTRIES of them, holding at most FIGURE_CACHE_MAX_BYTES of trace data
+FIGURE_CACHE_ENTRIES = 128
+FIGURE_CACHE_MAX_BYTES = int(os.environ.get("SDMX_FIGURE_CACHE_MB", "256")) * 1024 * 1024
+
+# Trace attributes holding one value per point
+_TRACE_ARRAYS = ["x", "y", "customdata", "hovertext", "text"]
+
+
+def lttb_indices(x, y, n_out):
+    """
+    Largest-Triangle-Three-Buckets: returns the positions of the `n_out`
+    points that best preserve the shape of the (x, y) series (x sorted).
+    """
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    edges = np.floor(np.linspace(1, n - 1, n_out - 1)).astype(int)
+    selected = np.empty(n_out, dtype=int)
+    selected[0] = 0
+    a = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        if i + 2 < len(edges):
+            next_start, next_end = edges[i + 1], edges[i + 2]
+        else:
+            next_start, next_end = n - 1, n
+        avg_x = x[next_start:next_end].mean()
+        avg_y = y[next_start:next_end].mean()
+        area = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(np.argmax(area))
+        selected[i + 1] = a
+    selected[-1] = n - 1
+    return selected
+
+
+def downsample(df_agg, x, y, group=None, max_points=MAX_PLOT_POINTS):
+    """
+    Downsamples each colour group of an aggregated frame with LTTB, so the
+    total stays around `max_points`. Non-numeric X values (e.g. "2020-03")
+    are placed by their sort order.
+    """
+    groups = [(None, df_agg)] if group is None else list(df_agg.groupby(group, observed=True, sort=False))
+    per_group = max(max_points // max(len(groups), 1), MIN_POINTS_PER_GROUP)
+    parts = []
+    for _, part in groups:
+        part = part.dropna(subset=[y]).sort_values(x)
+        if len(part) <= per_group:
+            parts.append(part)
+            continue
+        if pd.api.types.is_numeric_dtype(part[x]):
+            x_values = part[x].to_numpy(dtype=float)
+        else:
+            x_values = np.arange(len(part), dtype=float)
+        keep = lttb_indices(x_values, part[y].to_numpy(dtype=float), per_group)
+        parts.append(part.iloc[keep])
+    return pd.concat(parts, ignore_index=True) if parts else df_agg
+
+
+def build_figure(df_agg, chart_type, x, y, group=None, title=None):
+    """
+    Builds the chart of an aggregated frame. Large frames use WebGL traces
+    and line/scatter charts are downsampled. Returns (figure, note) where
+    note describes the downsampling (None when the full data is drawn);
+    figure is None for an unsupported chart type.
+    """
+    points = len(df_agg)
+    large = points > LARGE_FIGURE_POINTS
+    note = None
+    if large and chart_type in ("Line Chart", "Scatter Plot") and pd.api.types.is_numeric_dtype(df_agg[y]):
+        df_agg = downsample(df_agg, x, y, group)
+        if len(df_agg) < points:
+            note = f"Large series: showing {len(df_agg):,} of {points:,} points (shape-preserving LTTB downsampling per group)."
+    render_mode = "webgl" if large else "auto"
+
+    if chart_type == "Bar Chart":
+        fig = px.bar(df_agg, x=x, y=y, color=group, barmode="group")
+    elif chart_type == "Line Chart":
+        fig = px.line(df_agg, x=x, y=y, color=group, markers=True, render_mode=render_mode)
+    elif chart_type == "Scatter Plot":
+        fig = px.scatter(df_agg, x=x, y=y, color=group, render_mode=render_mode)
+    else:
+        return None, None
+
+    if title:
+        # Left-align the title (x=0 with left anchor)
+        fig.update_layout(title_text=title, title_x=0, title_xanchor="left", title_font=dict(size=20))
+    return fig, note
+
+
+def figure_bytes(fig):
+    """
+    Approximate memory held by the per-point data of a figure's traces.
+    """
+    size = 0
+    for trace in fig.data:
+        for name in _TRACE_ARRAYS:
+            values = getattr(trace, name, None)
+            if values is not None and not isinstance(values, str):
+                size += int(pd.Series(values).memory_usage(deep=True, index=False))
+    return size
+
+
+_figures = OrderedDict()
+_figures_size = 0
+_figures_lock = threading.Lock()
+
+
+def cached_figure(key, get_data, chart_type, x, y, group=None, title=None):
+    """
+    build_figure, memoized under `key` (which must identify the data version
+    and every chart setting) in a process-wide LRU bounded by
+    FIGURE_CACHE_ENTRIES and FIGURE_CACHE_MAX_BYTES. `get_data` returns the
+    aggregated frame and is only called on a miss. The figure objects are
+    cached, not their JSON: st.plotly_chart serializes the figure it is given
+    on every run.
+    """
+    global _figures_size
+    with _figures_lock:
+        if key in _figures:
+            _figures.move_to_end(key)
+            increment("figure_cache_total", result="hit")
+            return _figures[key][0]
+    increment("figure_cache_total", result="miss")
+    df_agg = get_data()
+    with span("build_figure", points=len(df_agg)):
+        result = build_figure(df_agg, chart_type, x, y, group, title)
+    size = figure_bytes(result[0]) if result[0] is not None else 0
+    if size > FIGURE_CACHE_MAX_BYTES:
+        return result
+    with _figures_lock:
+        if key in _figures:
+            _figures_size -= _figures.pop(key)[1]
+        _figures[key] = (result, size)
+        _figures_size += size
+        while len(_figures) > FIGURE_CACHE_ENTRIES or _figures_size > FIGURE_CACHE_MAX_BYTES:
+            _figures_size -= _figures.popitem(last=False)[1][1]
+    return result
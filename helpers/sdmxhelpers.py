@@ -0,0 +1,804 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
+from io import BytesIO
+from urllib.parse import urlencode
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+import requests
+from requests.adapters import HTTPAdapter
+
+from helpers.cachehelpers import CACHE_DIR, atomic_write_json, get_response_cache
+from helpers.datahelpers import describe_flow, normalize_columns
+from helpers.labelhelpers import (
+    attach_labels,
+    disable_lean,
+    layout_matches,
+    learn_label_layout,
+    load_label_layout,
+    parse_codelist,
+    save_label_layout,
+)
+from helpers.metrichelpers import bind_run, increment, span
+from helpers.serieshelpers import FULL_REFRESH_SECONDS, get_series_store, unchanged_rows
+
+
+# Can point to another SDMX REST endpoint (e.g. the local mock of benchmarks/mock_sdmx.py)
+SDMX_API_URL = os.environ.get("SDMX_API_URL", "https://sdmx.data.unicef.org/ws/public/sdmxapi/rest/")
+SDMX_DATA_URL = SDMX_API_URL + "data/"
+
+# Dimension ids used for the geography and the indicator across UNICEF data structures
+GEOGRAPHY_DIMENSIONS = ["REF_AREA", "GEOGRAPHIC_AREA", "COUNTRY", "AREA"]
+INDICATOR_DIMENSIONS = ["INDICATOR", "UNICEF_INDICATOR"]
+
+# Parsed data structures rarely change, keep them on disk for a week
+STRUCTURE_CACHE_DIR = os.path.join(CACHE_DIR, "structures")
+CODELIST_CACHE_DIR = os.path.join(CACHE_DIR, "codelists")
+STRUCTURE_TTL = 7 * 24 * 3600
+
+# Upper bound on the number of SDMX requests running at the same time
+MAX_CONCURRENT_REQUESTS = 6
+REQUEST_TIMEOUT = 120
+
+# Transient failures are retried on their own, with exponential backoff
+MAX_RETRIES = 2
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# Large selections are split into batches of keys: URLs stay under
+# MAX_URL_LENGTH and each batch is expected to return at most
+# MAX_ROWS_PER_BATCH rows (EXPECTED_ROWS_PER_SERIES per geography x indicator)
+MAX_URL_LENGTH = 2000
+MAX_ROWS_PER_BATCH = 250_000
+EXPECTED_ROWS_PER_SERIES = 500
+
+# Rows parsed at a time
+PARSE_CHUNK_ROWS = 100_000
+
+# Keys built from a data structure are kept in the local series store and
+# refreshed with updatedAfter deltas instead of full downloads ("0" disables it).
+# The watermark is moved back by WATERMARK_OVERLAP seconds to allow for clock skew.
+INCREMENTAL_REFRESH = os.environ.get("SDMX_INCREMENTAL_REFRESH", "1") == "1"
+WATERMARK_OVERLAP = 300
+
+# Lean payloads ("1" enables them): once a labelled response of a dataflow has
+# been seen, its data is requested with codes only (labels=id) and the label
+# columns are rebuilt from the learned labels and the dimension codelists
+LEAN_PAYLOADS = os.environ.get("SDMX_LEAN_PAYLOADS", "0") == "1"
+
+_session = None
+_session_lock = threading.Lock()
+_request_slots = threading.BoundedSemaphore(MAX_CONCURRENT_REQUESTS)
+# Batches of a split flow run here, apart from the flow workers waiting on them
+_batch_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS, thread_name_prefix="sdmx-batch")
+
+
+class RateLimiter:
+    """
+    Spaces out requests so that at most `rate` of them start per second.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+# No rate limit by default; the batch export sets one
+_rate_limiter = None
+
+
+def set_rate_limit(requests_per_second):
+    """
+    Limits the SDMX requests of this process to `requests_per_second` (None removes the limit).
+    """
+    global _rate_limiter
+    _rate_limiter = RateLimiter(requests_per_second) if requests_per_second else None
+
+
+def _throttle():
+    if _rate_limiter is not None:
+        _rate_limiter.wait()
+
+
+def get_session():
+    """
+    Returns the keep-alive HTTP session shared by every fetch in this process.
+    The connection pool is sized to MAX_CONCURRENT_REQUESTS so parallel fetches
+    reuse connections instead of opening a new one per request.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=MAX_CONCURRENT_REQUESTS,
+                pool_maxsize=MAX_CONCURRENT_REQUESTS,
+            )
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            session.headers.update({"Accept-Encoding": "gzip, deflate"})
+            _session = session
+    return _session
+
+
+def parse_structure(xml_bytes):
+    """
+    Parses an SDMX-ML structure message and returns the key layout of its data
+    structure: {"id": ..., "dimensions": [{"id": ..., "codelist": {...}}, ...]}
+    with dimensions in key order (the time dimension is not part of the key).
+    """
+    root = ET.fromstring(xml_bytes)
+    for dsd in root.iter():
+        if not dsd.tag.endswith("}DataStructure"):
+            continue
+        dimension_list = next((el for el in dsd.iter() if el.tag.endswith("}DimensionList")), None)
+        if dimension_list is None:
+            continue
+        dimensions = []
+        # Only the direct children: attributes also reference dimensions by <Dimension><Ref/>
+        for dim in dimension_list:
+            if not dim.tag.endswith("}Dimension"):
+                continue
+            codelist = None
+            for ref in dim.iter():
+                if ref.tag.endswith("}Enumeration"):
+                    for child in ref:
+                        # <Ref> is unqualified in SDMX-ML 2.1
+                        if child.tag.split("}")[-1] == "Ref":
+                            codelist = {
+                                "agency": child.get("agencyID"),
+                                "id": child.get("id"),
+                                "version": child.get("version"),
+                            }
+            dimensions.append({"id": dim.get("id"), "position": int(dim.get("position", len(dimensions) + 1)), "codelist": codelist})
+        dimensions.sort(key=lambda d: d["position"])
+        return {"id": dsd.get("id"), "dimensions": dimensions}
+    return None
+
+
+_structures = {}
+_structures_lock = threading.Lock()
+
+
+def get_structure(agency, dataflow_id, version="1.0"):
+    """
+    Returns the parsed data structure of a dataflow.
+    Structures are kept in memory for the life of the process and on disk
+    for STRUCTURE_TTL, so the API is only asked once per dataflow.
+    """
+    key = f"{agency},{dataflow_id},{version}"
+    with _structures_lock:
+        if key in _structures:
+            return _structures[key]
+
+    path = os.path.join(STRUCTURE_CACHE_DIR, f"{agency}_{dataflow_id}_{version}.json")
+    structure = None
+    if os.path.exists(path) and time.time() - os.path.getmtime(path) < STRUCTURE_TTL:
+        with open(path) as f:
+            structure = json.load(f)
+
+    if structure is None:
+        url = f"{SDMX_API_URL}dataflow/{agency}/{dataflow_id}/{version}?references=datastructure"
+        _throttle()
+        with _request_slots, span("structure_request", dataflow=dataflow_id):
+            response = get_session().get(url, timeout=REQUEST_TIMEOUT)
+        increment("structure_requests_total")
+        response.raise_for_status()
+        structure = parse_structure(response.content)
+        if structure is not None:
+            os.makedirs(STRUCTURE_CACHE_DIR, exist_ok=True)
+            atomic_write_json(path, structure)
+
+    with _structures_lock:
+        _structures[key] = structure
+    return structure
+
+
+def get_codelist(codelist):
+    """
+    Returns {code: name} for a codelist reference ({"agency", "id", "version"}
+    as in the parsed structure), cached on disk like the structures.
+    """
+    path = os.path.join(CODELIST_CACHE_DIR, f"{codelist['agency']}_{codelist['id']}_{codelist['version']}.json")
+    if os.path.exists(path) and time.time() - os.path.getmtime(path) < STRUCTURE_TTL:
+        with open(path) as f:
+            return json.load(f)
+
+    url = f"{SDMX_API_URL}codelist/{codelist['agency']}/{codelist['id']}/{codelist['version']}"
+    _throttle()
+    with _request_slots, span("codelist_request", codelist=codelist["id"]):
+        response = get_session().get(url, timeout=REQUEST_TIMEOUT)
+    increment("codelist_requests_total")
+    response.raise_for_status()
+    labels = parse_codelist(response.content)
+    os.makedirs(CODELIST_CACHE_DIR, exist_ok=True)
+    atomic_write_json(path, labels)
+    return labels
+
+
+def build_key(structure, geography_codes, indicator_codes):
+    """
+    Builds the SDMX series key of a query from the dimension order of its
+    data structure. Returns None when the geography or indicator dimension
+    cannot be identified.
+    """
+    dimension_ids = [d["id"] for d in structure["dimensions"]]
+    geo_dim = next((d for d in GEOGRAPHY_DIMENSIONS if d in dimension_ids), None)
+    indicator_dim = next((d for d in INDICATOR_DIMENSIONS if d in dimension_ids), None)
+    if geo_dim is None or indicator_dim is None:
+        return None
+    values = {geo_dim: "+".join(geography_codes), indicator_dim: "+".join(indicator_codes)}
+    return ".".join(values.get(d, "") for d in dimension_ids)
+
+
+def data_url(query, key, labels="both", **params):
+    """
+    Returns the CSV data URL of a key, with codes and labels ("both") or
+    codes only ("id"); `params` are added to the query string (e.g.
+    updatedAfter or startPeriod).
+    """
+    url = (
+        f"{SDMX_DATA_URL}"
+        f"{query['agency']},{query['dataflow_id']},{query.get('version', '1.0')}/{key}"
+        f"?format=csv&labels={labels}"
+    )
+    if params:
+        url += "&" + urlencode(params)
+    return url
+
+
+def guessed_urls(query):
+    """
+    The historical guesses of the key layout, used when the data structure of
+    a dataflow cannot be fetched or recognised.
+    """
+    geography_id_str = "+".join(query["geography_ids"])
+    geography_str = "+".join(query["geographies"])
+    indicator_id_str = "+".join(query["indicator_ids"])
+    return [
+        data_url(query, f"{geography_id_str}.{indicator_id_str}"),
+        data_url(query, f".{geography_id_str}..{indicator_id_str}"),
+        data_url(query, f"{indicator_id_str}..{geography_str}."),
+    ]
+
+
+def _chunk_codes(codes, max_chars, max_count):
+    if not codes:
+        return [[]]
+    chunks, current, length = [], [], 0
+    for code in codes:
+        extra = len(code) + (1 if current else 0)
+        if current and (length + extra > max_chars or len(current) >= max_count):
+            chunks.append(current)
+            current, length, extra = [], 0, len(code)
+        current.append(code)
+        length += extra
+    chunks.append(current)
+    return chunks
+
+
+def split_codes(base_length, geography_codes, indicator_codes):
+    """
+    Splits the geography and indicator codes of a query into batches whose
+    URL stays under MAX_URL_LENGTH and whose expected row count stays under
+    MAX_ROWS_PER_BATCH. Returns a list of (geography_codes, indicator_codes).
+    """
+    budget = max(MAX_URL_LENGTH - base_length, 1)
+    max_series = max(MAX_ROWS_PER_BATCH // EXPECTED_ROWS_PER_SERIES, 1)
+    batches = []
+    for indicators in _chunk_codes(indicator_codes, budget // 2, max_series):
+        chars_left = max(budget - len("+".join(indicators)), 1)
+        per_batch = max(max_series // max(len(indicators), 1), 1)
+        for geographies in _chunk_codes(geography_codes, chars_left, per_batch):
+            batches.append((geographies, indicators))
+    return batches
+
+
+def candidate_urls(query, labels="both"):
+    """
+    Returns the batches of URLs to fetch for a query, a note for the page and
+    the columns identifying an observation (None when they are unknown).
+    Each batch is the list of URLs to try in turn. When the data structure is
+    known, the key is built from it and large selections are split into
+    several batches of one URL each; otherwise there is a single batch with
+    the guessed layouts (always with labels).
+    """
+    try:
+        structure = get_structure(query["agency"], query["dataflow_id"], query.get("version", "1.0"))
+    except Exception as e:
+        return [guessed_urls(query)], f"Could not load the data structure ({e}), trying known key layouts.", None
+    if structure is not None:
+        # National queries use geography ids, subnational ones the area codes
+        geography_codes = query["geography_ids"] if query.get("national", True) else query["geographies"]
+        if build_key(structure, geography_codes, query["indicator_ids"]) is not None:
+            base_length = len(data_url(query, "." * len(structure["dimensions"])))
+            batches = [
+                [data_url(query, build_key(structure, geographies, indicators), labels)]
+                for geographies, indicators in split_codes(base_length, geography_codes, query["indicator_ids"])
+            ]
+            dims = ".".join(d["id"] for d in structure["dimensions"])
+            note = f"Key built from data structure {structure['id']} ({dims})"
+            if len(batches) > 1:
+                note += f", split into {len(batches)} batches"
+            key_columns = [d["id"] for d in structure["dimensions"]] + ["TIME_PERIOD"]
+            return batches, note, key_columns
+    return [guessed_urls(query)], "Data structure not recognised, trying known key layouts.", None
+
+
+def _as_text_category(values):
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        return values.cat.rename_categories([str(c) for c in values.cat.categories])
+    return values.astype(object).where(values.isna(), values.astype(str)).astype("category")
+
+
+def _restore_numbers(df):
+    """
+    Converts back to numbers the text columns whose values are all numeric
+    (integers when no value is missing), like a plain read_csv would.
+    """
+    if df.empty:
+        return df
+    for col in df.columns:
+        if not isinstance(df[col].dtype, pd.CategoricalDtype):
+            continue
+        try:
+            numbers = pd.to_numeric(df[col].cat.categories)
+        except (ValueError, TypeError):
+            continue
+        codes = df[col].cat.codes.to_numpy()
+        if pd.api.types.is_integer_dtype(numbers) and (codes >= 0).all():
+            df[col] = numbers.to_numpy()[codes]
+        else:
+            df[col] = np.append(numbers.to_numpy(dtype="float64"), np.nan)[codes]
+    return df
+
+
+def _concat_chunks(chunks):
+    """
+    Concatenates parsed chunks (or batches of one flow), merging the categories of categorical columns
+    (a plain pd.concat would fall back to object dtype when they differ).
+    """
+    if len(chunks) == 1:
+        return chunks[0]
+    if any(list(chunk.columns) != list(chunks[0].columns) for chunk in chunks):
+        return pd.concat(chunks, ignore_index=True)
+    data = {}
+    for col in chunks[0].columns:
+        parts = [chunk[col] for chunk in chunks]
+        categorical = [isinstance(part.dtype, pd.CategoricalDtype) for part in parts]
+        if any(categorical) and not all(categorical):
+            # A column numeric in one part and text in another is kept as text
+            parts = [_as_text_category(part) for part in parts]
+        if any(categorical):
+            # Sorted, so that periods brought by a later chunk or batch keep their order
+            data[col] = union_categoricals(parts, sort_categories=True)
+        else:
+            data[col] = pd.concat(parts, ignore_index=True)
+    return pd.DataFrame(data)
+
+
+def parse_sdmx_csv(body, flow, chunksize=PARSE_CHUNK_ROWS):
+    """
+    Parses an SDMX CSV payload (bytes) into a DataFrame tagged with its dataflow name.
+    The payload is read in row chunks straight from the bytes, with every
+    column but OBS_VALUE parsed as a categorical so each distinct string is
+    stored once and all chunks agree on the type of each column. Once the
+    chunks are merged, the columns holding only numbers are converted back;
+    OBS_VALUE is float64 and a yearly TIME_PERIOD is stored as a small integer.
+    """
+    header = pd.read_csv(BytesIO(body), nrows=0)
+    dtypes = {col: "category" for col in header.columns if col != "OBS_VALUE"}
+
+    chunks = []
+    for chunk in pd.read_csv(BytesIO(body), dtype=dtypes, chunksize=chunksize):
+        # Convert OBS_VALUE to float, if present.
+        if "OBS_VALUE" in chunk.columns:
+            chunk["OBS_VALUE"] = pd.to_numeric(chunk["OBS_VALUE"], errors="coerce").astype("float64")
+        chunks.append(chunk)
+    if not chunks:
+        df_data_flow = header
+    else:
+        df_data_flow = _restore_numbers(_concat_chunks(chunks))
+
+    if "TIME_PERIOD" in df_data_flow.columns and pd.api.types.is_integer_dtype(df_data_flow["TIME_PERIOD"]):
+        df_data_flow["TIME_PERIOD"] = pd.to_numeric(df_data_flow["TIME_PERIOD"], downcast="integer")
+    df_data_flow["dataflow"] = pd.Series(flow, index=df_data_flow.index, dtype="category")
+    return df_data_flow
+
+
+def _local_cache_call(method, *args, **kwargs):
+    """
+    Calls a method of the response cache or series store. A broken local
+    cache (locked database, full disk) is logged and treated as a miss
+    (None), so it costs a request, not the fetch.
+    """
+    try:
+        return method(*args, **kwargs)
+    except (sqlite3.Error, OSError) as e:
+        increment("local_cache_errors_total")
+        logging.getLogger(__name__).warning("Local cache error: %s", e)
+        return None
+
+
+def get_url(url, session=None, cache=None, use_cache=True, revalidate=False):
+    """
+    GETs an SDMX URL through the shared on-disk response cache.
+    Fresh entries are returned without a request, stale ones are revalidated
+    with their ETag / Last-Modified. Returns (status_code, body bytes, source)
+    where source is "cache", "revalidated" or "network".
+    With revalidate=True even a fresh entry is revalidated, so the body is
+    current as of the call (for full syncs of the series store).
+    With use_cache=False the cache is neither read nor written (for one-off
+    delta requests).
+    """
+    session = session or get_session()
+    cache = cache or get_response_cache()
+    entry = None
+    if use_cache:
+        with span("response_cache_lookup"):
+            entry = _local_cache_call(cache.get, url)
+    if entry is not None and entry["fresh"] and not revalidate:
+        increment("response_cache_total", result="hit")
+        return 200, entry["body"], "cache"
+
+    _throttle()
+    with _request_slots, span("sdmx_request"):
+        response = session.get(url, headers=cache.validators(entry), timeout=REQUEST_TIMEOUT)
+    increment("sdmx_requests_total", status=response.status_code)
+    increment("payload_bytes_total", len(response.content))
+    if response.status_code == 304 and entry is not None:
+        increment("response_cache_total", result="revalidated")
+        _local_cache_call(cache.revalidated, url)
+        return 200, entry["body"], "revalidated"
+    if not use_cache:
+        return response.status_code, response.content, "network"
+    increment("response_cache_total", result="miss")
+    if response.status_code == 200:
+        _local_cache_call(
+            cache.put,
+            url,
+            response.content,
+            etag=response.headers.get("ETag"),
+            last_modified=response.headers.get("Last-Modified"),
+        )
+    return response.status_code, response.content, "network"
+
+
+def _get_with_retries(url, use_cache=True, revalidate=False):
+    """
+    GETs a URL (see get_url), retrying transient failures with exponential
+    backoff. Returns (status_code, body, source, error) where error is the
+    exception of a request that failed without an answer.
+    """
+    for retry in range(MAX_RETRIES + 1):
+        try:
+            status_code, body, source = get_url(url, use_cache=use_cache, revalidate=revalidate)
+        except requests.RequestException as e:
+            status_code, body, source, error = None, None, None, e
+        else:
+            error = None
+        if status_code not in RETRY_STATUS_CODES and error is None:
+            break
+        if retry < MAX_RETRIES:
+            increment("retries_total")
+            time.sleep(2 ** retry)
+    return status_code, body, source, error
+
+
+def _batch_status(http_status=None, error=None, stale=False):
+    """
+    What happened to one batch: the HTTP status of its last answer, the type
+    of the exception that failed it, whether stored data was served because
+    the refresh failed, and whether trying again later could help.
+    """
+    return {
+        "http_status": http_status,
+        "error": type(error).__name__ if error is not None else None,
+        "stale": stale,
+        "transient": isinstance(error, requests.RequestException) or http_status in RETRY_STATUS_CODES,
+    }
+
+
+def _flow_status(results):
+    """
+    Sums up the (data, batch status) of every batch of a flow. "complete" is
+    False when a batch failed (the data is "partial" when others did not)
+    or when stored data was served instead of a refresh ("stale").
+    """
+    failed = [status for data, status in results if data is None]
+    degraded = failed + [status for data, status in results if data is not None and status["stale"]]
+    last = degraded[-1] if degraded else results[-1][1]
+    return {
+        "complete": not degraded,
+        "batches": len(results),
+        "failed_batches": len(failed),
+        "partial": 0 < len(failed) < len(results),
+        "stale": any(status["stale"] for _, status in results),
+        "http_status": last["http_status"],
+        "error": last["error"],
+        "transient": any(status["transient"] for status in degraded),
+    }
+
+
+def _fetch_first(flow, urls, revalidate=False):
+    """
+    Tries each URL in turn until one answers with 200, retrying transient
+    failures of a URL before moving on (see get_url for revalidate).
+    Returns (DataFrame or None, messages, batch status).
+    """
+    messages = []
+    status = _batch_status()
+    labels = ["API", "Fallback API", "Tertiary API"]
+    for attempt, url in enumerate(urls):
+        label = labels[attempt] if attempt < len(labels) else f"Fallback API #{attempt}"
+        messages.append(("code", url))
+        if attempt > 0:
+            increment("fallback_urls_total")
+        status_code, body, source, error = _get_with_retries(url, revalidate=revalidate)
+
+        if error is not None:
+            status = _batch_status(error=error)
+            messages.append(("error", f"{label} call for dataflow {flow} failed: {error}"))
+            continue
+
+        if status_code == 200:
+            if source != "network":
+                messages.append(("write", f"Served from cache ({source})"))
+            try:
+                with span("parse", flow=flow, bytes=len(body)):
+                    data = parse_sdmx_csv(body, flow)
+                increment("rows_parsed_total", len(data))
+                return data, messages, _batch_status(status_code)
+            except Exception as e:
+                messages.append(("error", f"Error reading CSV data for {flow}: {e}"))
+                return None, messages, _batch_status(status_code, e)
+
+        status = _batch_status(status_code)
+        messages.append(("error", f"{label} call for dataflow {flow} failed with status code: {status_code}"))
+
+    return None, messages, status
+
+
+def _watermark(timestamp):
+    return datetime.fromtimestamp(timestamp - WATERMARK_OVERLAP, timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def _store_series(store, url, data, synced_at, full_sync_at):
+    # The data is returned even when it cannot be stored; the next fetch downloads it again
+    try:
+        store.put(url, data, synced_at=synced_at, full_sync_at=full_sync_at)
+    except Exception as e:
+        increment("series_store_errors_total")
+        logging.getLogger(__name__).warning("Could not store the series of %s: %s", url, e)
+
+
+def _fetch_series(flow, url, key_columns):
+    """
+    Fetches the data of one key through the local series store. The first
+    fetch (and one every FULL_REFRESH_SECONDS) downloads the whole history;
+    later ones only ask for the observations updated since the last sync
+    (updatedAfter) and merge them in, the delta replacing revised
+    observations. When the endpoint rejects updatedAfter, everything from the
+    latest stored period on is downloaded again instead (startPeriod).
+    Returns (DataFrame or None, messages, batch status).
+    """
+    store = get_series_store()
+    with span("series_store_lookup"):
+        entry = _local_cache_call(store.get, url)
+    now = time.time()
+    if entry is None or now - entry["full_sync_at"] > FULL_REFRESH_SECONDS:
+        increment("series_store_total", result="full")
+        # Through the response cache: an unchanged history is a 304, not a new download
+        data, messages, status = _fetch_first(flow, [url], revalidate=True)
+        if data is not None:
+            _store_series(store, url, data, synced_at=now, full_sync_at=now)
+        return data, messages, status
+
+    stored = entry["data"]
+    stored["dataflow"] = pd.Series(flow, index=stored.index, dtype="category")
+    if now - entry["synced_at"] < store.ttl_for(url):
+        increment("series_store_total", result="hit")
+        return stored, [("code", url), ("write", "Served from the local series store")], _batch_status(200)
+
+    start_period = None
+    delta_url = url + "&" + urlencode({"updatedAfter": _watermark(entry["synced_at"])})
+    messages = [("code", delta_url)]
+    status_code, body, _, error = _get_with_retries(delta_url, use_cache=False)
+    if status_code in (400, 501) and "TIME_PERIOD" in stored.columns and len(stored):
+        # Compared as text: a non-yearly TIME_PERIOD ("2020-01") is an unordered categorical
+        start_period = stored["TIME_PERIOD"].astype(str).max()
+        delta_url = url + "&" + urlencode({"startPeriod": start_period})
+        messages.append(("code", delta_url))
+        status_code, body, _, error = _get_with_retries(delta_url, use_cache=False)
+
+    if status_code == 404:
+        # SDMX answers 404 (NoResultsFound) when nothing was updated
+        increment("series_store_total", result="unchanged")
+        _local_cache_call(store.touch, url, now)
+        messages.append(("write", "No updates since the last sync"))
+        return stored, messages, _batch_status(status_code)
+
+    delta = None
+    if status_code == 200:
+        try:
+            with span("parse", flow=flow, bytes=len(body)):
+                delta = parse_sdmx_csv(body, flow)
+            with span("merge_delta", flow=flow, rows=len(delta)):
+                data = _concat_chunks([unchanged_rows(stored, delta, key_columns, start_period), delta])
+        except Exception as e:
+            delta, error = None, e
+    if delta is None:
+        increment("series_store_total", result="stale")
+        synced = datetime.fromtimestamp(entry["synced_at"]).strftime("%Y-%m-%d %H:%M")
+        reason = error or f"status code {status_code}"
+        messages.append(("error", f"Could not refresh dataflow {flow} ({reason}), showing the data synced on {synced}."))
+        return stored, messages, _batch_status(status_code, error, stale=True)
+
+    increment("series_store_total", result="delta")
+    increment("delta_rows_total", len(delta))
+    _store_series(store, url, data, synced_at=now, full_sync_at=entry["full_sync_at"])
+    messages.append(("write", f"Merged {len(delta)} new or revised observations"))
+    return data, messages, _batch_status(status_code)
+
+
+def _fetch_batch(flow, urls, key_columns):
+    if INCREMENTAL_REFRESH and key_columns is not None and len(urls) == 1:
+        return _fetch_series(flow, urls[0], key_columns)
+    return _fetch_first(flow, urls)
+
+
+def _ingest(flow, data, messages, status):
+    """
+    Normalizes the column names of a fetched flow and precomputes its
+    metadata, once, in the worker thread.
+    """
+    if data is None:
+        return {"flow": flow, "data": None, "meta": None, "messages": messages, "status": status}
+    with span("ingest", flow=flow, rows=len(data)):
+        data = normalize_columns(data)
+        meta = describe_flow(data)
+    return {"flow": flow, "data": data, "meta": meta, "messages": messages, "status": status}
+
+
+def _fetch_batches(flow, batches, key_columns, messages):
+    """
+    Fetches the batches of a flow (in parallel when there are several, each
+    one retried on its own) and merges them into one frame, dropping rows
+    returned by more than one batch. Returns (the frame or None, flow status).
+    """
+    if len(batches) == 1:
+        data, batch_messages, status = _fetch_batch(flow, batches[0], key_columns)
+        messages.extend(batch_messages)
+        return data, _flow_status([(data, status)])
+
+    increment("batches_total", len(batches))
+    futures = [_batch_executor.submit(bind_run(_fetch_batch), flow, urls, key_columns) for urls in batches]
+    results = []
+    for future in futures:
+        data, batch_messages, status = future.result()
+        messages.extend(batch_messages)
+        results.append((data, status))
+    status = _flow_status(results)
+    frames = [data for data, _ in results if data is not None]
+    if not frames:
+        return None, status
+    if status["partial"]:
+        messages.append(("error", f"{status['failed_batches']} of {len(batches)} batches failed for dataflow {flow}, showing partial data."))
+    return _concat_chunks(frames).drop_duplicates(ignore_index=True), status
+
+
+def _label_lean_frame(flow, query, data, layout, messages):
+    """
+    Rebuilds the label columns of a frame fetched with codes only. Codes the
+    layout has not seen are looked up in the codelists of the data
+    structure, and the layout is extended with them. Returns None when the
+    labels cannot be rebuilt (the caller then fetches them from the API).
+    """
+    structure = get_structure(query["agency"], query["dataflow_id"], query.get("version", "1.0"))
+    codelists = {d["id"]: d["codelist"] for d in structure["dimensions"] if d["codelist"]}
+    fetched = {}
+
+    def codelist_for(column):
+        if column not in codelists:
+            return None
+        try:
+            fetched[column] = get_codelist(codelists[column])
+        except (requests.RequestException, ET.ParseError) as e:
+            messages.append(("write", f"Could not load the codelist of {column} ({e})"))
+            return None
+        return fetched[column]
+
+    with span("attach_labels", flow=flow, rows=len(data)):
+        labelled = attach_labels(data, layout, codelist_for)
+    if labelled is None:
+        return None
+    if fetched:
+        for column, labels in fetched.items():
+            layout["labels"][column]["values"].update(labels)
+        save_label_layout(query, layout)
+    return labelled
+
+
+def fetch_flow(flow, query):
+    """
+    Fetches one dataflow. When the selection was split into several batches,
+    they are fetched in parallel and merged into one frame.
+    With LEAN_PAYLOADS, a dataflow whose label layout is known is fetched
+    with codes only and labelled locally; if that fails it is fetched again
+    with labels, which also updates the layout.
+    Runs in a worker thread, so it never calls Streamlit: the messages for the
+    page are returned as (kind, text) tuples for the caller to render.
+    Local cache errors that could not be worked around fail this flow only.
+    Returns {"flow", "data", "meta", "messages", "status"}; status tells
+    callers whether the data is complete, partial or stale, with the last
+    HTTP status or exception type (see _flow_status).
+    """
+    messages = [("write", f"Fetching data for dataflow: {flow}")]
+    try:
+        return _fetch_flow(flow, query, messages)
+    except (sqlite3.Error, OSError) as e:
+        increment("local_cache_errors_total")
+        messages.append(("error", f"Could not fetch dataflow {flow}: local cache error ({e})"))
+        status = _flow_status([(None, _batch_status(error=e))])
+        # A locked database is worth another try, a full disk is not
+        status["transient"] = isinstance(e, sqlite3.OperationalError)
+        return _ingest(flow, None, messages, status)
+
+
+def _fetch_flow(flow, query, messages):
+    layout = load_label_layout(query) if LEAN_PAYLOADS else None
+    lean = layout is not None and layout.get("lean", True)
+    with span("build_key", flow=flow):
+        batches, note, key_columns = candidate_urls(query, labels="id" if lean else "both")
+    messages.append(("write", note))
+    data, status = _fetch_batches(flow, batches, key_columns, messages)
+
+    if data is not None and lean and key_columns is not None:
+        labelled = _label_lean_frame(flow, query, data, layout, messages)
+        if labelled is not None:
+            increment("lean_payloads_total", result="labelled")
+            return _ingest(flow, labelled, messages, status)
+        increment("lean_payloads_total", result="fallback")
+        if not layout_matches(data, layout):
+            disable_lean(query, layout)
+        messages.append(("write", "Labels could not be rebuilt from the cached codelists, fetching them from the API."))
+        batches, _, key_columns = candidate_urls(query)
+        data, status = _fetch_batches(flow, batches, key_columns, messages)
+
+    if data is not None and LEAN_PAYLOADS and key_columns is not None:
+        learned = learn_label_layout(data, layout)
+        # A dataflow that did not match its layout stays labelled unless its columns changed since
+        if layout is None or layout.get("lean", True) or learned["columns"] != layout["columns"]:
+            save_label_layout(query, learned)
+    return _ingest(flow, data, messages, status)
+
+
+def fetch_flows(jobs, max_workers=MAX_CONCURRENT_REQUESTS):
+    """
+    Fetches several dataflows in parallel.
+    `jobs` maps each dataflow name to its query: agency, dataflow_id,
+    geography_ids, geographies, indicator_ids and national.
+    Yields the result of each flow as soon as it finishes.
+    """
+    if not jobs:
+        return
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(jobs))) as executor:
+        futures = [executor.submit(bind_run(fetch_flow), flow, query) for flow, query in jobs.items()]
+        for future in as_completed(futures):
+            yield future.result()
@@ -0,0 +1,119 @@
+import re
+from bisect import bisect_left
+from collections import Counter, defaultdict
+
+import numpy as np
+
+
+# Mapping columns searched, and how much a match in each one counts
+SEARCH_FIELDS = {
+    "indicator": 4.0,
+    "indicator_id": 3.0,
+    "category": 1.5,
+    "dataflow_name": 1.0,
+}
+# A whole word counts fully, a word that only starts with the query word less,
+# and a misspelt word (sharing enough trigrams) less again
+PREFIX_MATCH = 0.6
+FUZZY_MATCH = 0.4
+MIN_FUZZY_SIMILARITY = 0.4
+
+_WORD = re.compile(r"[0-9a-z]+")
+
+
+def _words(text):
+    # IDs such as CME_MRY0T4 are split into their parts, like the query
+    return _WORD.findall(str(text).lower())
+
+
+def _trigrams(word):
+    padded = f"  {word} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class IndicatorSearchIndex:
+    """
+    Inverted index over the indicators of the mapping file: every word of an
+    indicator's name, IDs, categories and dataflow names points to the
+    indicators that contain it, with the weight of its field
+    (SEARCH_FIELDS). Query words match whole words and word prefixes via a
+    sorted word list, and misspelt words via a trigram index of the
+    vocabulary. Built once per version of the mapping file.
+    """
+
+    def __init__(self, df):
+        self.indicators = df["indicator"].dropna().unique().tolist()
+        doc_of = {indicator: doc for doc, indicator in enumerate(self.indicators)}
+        categories = defaultdict(list)
+        postings = defaultdict(dict)
+        for col, weight in SEARCH_FIELDS.items():
+            if col not in df.columns:
+                continue
+            if col == "indicator":
+                pairs = zip(self.indicators, self.indicators)
+            else:
+                unique_pairs = df[["indicator", col]].drop_duplicates().dropna()
+                pairs = zip(unique_pairs["indicator"].tolist(), unique_pairs[col].tolist())
+            for indicator, value in pairs:
+                doc = doc_of[indicator]
+                for word in _words(value):
+                    if postings[word].get(doc, 0) < weight:
+                        postings[word][doc] = weight
+                if col == "category":
+                    categories[indicator].append(value)
+        self.categories = dict(categories)
+
+        self.words = sorted(postings)
+        self.postings = {
+            word: (np.fromiter(docs, dtype=np.int64), np.fromiter(docs.values(), dtype=np.float64))
+            for word, docs in postings.items()
+        }
+        self.trigrams = defaultdict(list)
+        for word in self.words:
+            for trigram in _trigrams(word):
+                self.trigrams[trigram].append(word)
+        # Ties are ranked alphabetically
+        order = sorted(range(len(self.indicators)), key=lambda doc: str(self.indicators[doc]).lower())
+        self.name_rank = np.empty(len(order), dtype=np.int64)
+        self.name_rank[order] = np.arange(len(order))
+
+    def _add(self, scores, word, factor):
+        docs, weights = self.postings[word]
+        scores[docs] = np.maximum(scores[docs], weights * factor)
+
+    def _word_scores(self, query_word):
+        scores = np.zeros(len(self.indicators))
+        position = bisect_left(self.words, query_word)
+        while position < len(self.words) and self.words[position].startswith(query_word):
+            word = self.words[position]
+            self._add(scores, word, 1.0 if word == query_word else PREFIX_MATCH)
+            position += 1
+        if scores.any() or len(query_word) < 3:
+            return scores
+
+        query_trigrams = _trigrams(query_word)
+        shared = Counter(word for trigram in query_trigrams for word in self.trigrams.get(trigram, ()))
+        for word, count in shared.items():
+            similarity = count / (len(query_trigrams) + len(_trigrams(word)) - count)
+            if similarity >= MIN_FUZZY_SIMILARITY:
+                self._add(scores, word, FUZZY_MATCH * similarity)
+        return scores
+
+    def search(self, text, limit=None):
+        """
+        Returns the indicators matching every word of `text`, best first.
+        """
+        query_words = list(dict.fromkeys(_words(text)))
+        if not query_words or not self.indicators:
+            return []
+        total = np.zeros(len(self.indicators))
+        matched = np.ones(len(self.indicators), dtype=bool)
+        for query_word in query_words:
+            scores = self._word_scores(query_word)
+            total += scores
+            matched &= scores > 0
+        docs = np.flatnonzero(matched)
+        docs = docs[np.lexsort((self.name_rank[docs], -total[docs]))]
+        if limit is not None:
+            docs = docs[:limit]
+        return [self.indicators[doc] for doc in docs]
@@ -0,0 +1,107 @@
+import hashlib
+import os
+
+import pandas as pd
+
+from helpers.cachehelpers import CACHE_DIR, LruIndex, atomic_write, dataflow_from_url, normalize_url
+
+
+# Parsed series, one Parquet file per dataflow and series key, with their sync watermarks
+SERIES_STORE_DIR = os.path.join(CACHE_DIR, "series")
+MAX_SERIES_BYTES = int(os.environ.get("SDMX_SERIES_STORE_MAX_MB", "1024")) * 1024 * 1024
+
+# Deltas cannot report deleted observations, so a full download is made once in a while
+FULL_REFRESH_SECONDS = 7 * 24 * 3600
+
+
+class SeriesStore(LruIndex):
+    """
+    Local store of the observations fetched for each data URL (dataflow and
+    series key), with the time they were last synced (the watermark) and the
+    time of their last full download. The frames are kept as Parquet files
+    and indexed in SQLite; the store is kept under `max_bytes` by dropping the
+    least recently used series.
+    """
+
+    def __init__(self, directory=SERIES_STORE_DIR, max_bytes=MAX_SERIES_BYTES):
+        self.directory = directory
+        super().__init__(
+            os.path.join(directory, "index.sqlite"),
+            "series",
+            "dataflow TEXT, file TEXT, rows INTEGER, synced_at REAL, full_sync_at REAL",
+            max_bytes,
+        )
+
+    def get(self, url):
+        """
+        Returns the stored series for `url` as a dict (data, synced_at,
+        full_sync_at) or None when nothing is stored.
+        """
+        row = self._lookup(normalize_url(url), "file, synced_at, full_sync_at")
+        if row is None:
+            return None
+        file, synced_at, full_sync_at = row
+        try:
+            data = pd.read_parquet(os.path.join(self.directory, file))
+        except (OSError, ValueError):
+            return None
+        return {"data": data, "synced_at": synced_at, "full_sync_at": full_sync_at}
+
+    def put(self, url, data, synced_at, full_sync_at):
+        key = normalize_url(url)
+        file = hashlib.sha1(key.encode("utf-8")).hexdigest() + ".parquet"
+        path = os.path.join(self.directory, file)
+        atomic_write(path, lambda tmp_path: data.to_parquet(tmp_path, index=False))
+        self._insert(
+            key,
+            os.path.getsize(path),
+            dataflow=dataflow_from_url(url),
+            file=file,
+            rows=len(data),
+            synced_at=synced_at,
+            full_sync_at=full_sync_at,
+        )
+
+    def touch(self, url, synced_at):
+        """
+        Moves the watermark of a series forward when the API reported no changes.
+        """
+        self._update(normalize_url(url), synced_at=synced_at)
+
+    def _remove(self, conn, key):
+        row = conn.execute("SELECT file FROM series WHERE url = ?", (key,)).fetchone()
+        super()._remove(conn, key)
+        if row is not None:
+            try:
+                os.remove(os.path.join(self.directory, row[0]))
+            except OSError:
+                pass
+
+
+def _observation_keys(df, key_columns):
+    return pd.MultiIndex.from_arrays([df[col].astype(str) for col in key_columns])
+
+
+def unchanged_rows(stored, delta, key_columns, start_period=None):
+    """
+    Returns the stored observations that a delta request leaves as they are.
+    With updatedAfter, the delta holds new and revised observations, which
+    replace the stored rows with the same dimension codes and TIME_PERIOD
+    (`key_columns`). With startPeriod, the delta is everything from
+    `start_period` on, so it replaces that whole window of the stored rows.
+    """
+    if start_period is not None and "TIME_PERIOD" in stored.columns:
+        # Compared as text: a non-yearly TIME_PERIOD ("2020-01") is an unordered categorical
+        return stored[stored["TIME_PERIOD"].astype(str) < str(start_period)]
+    columns = [col for col in key_columns if col in stored.columns and col in delta.columns]
+    return stored[~_observation_keys(stored, columns).isin(_observation_keys(delta, columns))]
+
+
+_series_store = None
+
+
+def get_series_store():
+    global _series_store
+    if _series_store is None:
+        _series_store = SeriesStore()
+    return _series_store
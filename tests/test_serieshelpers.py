@@ -0,0 +1,78 @@
+import pandas as pd
+
+from helpers.serieshelpers import unchanged_rows
+
+
+KEY_COLUMNS = ["REF_AREA", "INDICATOR", "TIME_PERIOD"]
+
+
+def _frame(rows, categorical=True):
+    df = pd.DataFrame(rows, columns=["REF_AREA", "INDICATOR", "TIME_PERIOD", "OBS_VALUE"])
+    if categorical:
+        for col in ["REF_AREA", "INDICATOR"]:
+            df[col] = df[col].astype("category")
+    return df
+
+
+def test_updated_after_drops_revised_observations():
+    stored = _frame([
+        ("AFG", "IM_DTP3", 2019, 60.0),
+        ("AFG", "IM_DTP3", 2020, 61.0),
+        ("ALB", "IM_DTP3", 2020, 95.0),
+    ])
+    # A revision of AFG 2020 and a new observation for AFG 2021
+    delta = _frame([
+        ("AFG", "IM_DTP3", 2020, 62.0),
+        ("AFG", "IM_DTP3", 2021, 63.0),
+    ])
+
+    kept = unchanged_rows(stored, delta, KEY_COLUMNS)
+
+    assert kept[["REF_AREA", "TIME_PERIOD"]].astype(str).values.tolist() == [["AFG", "2019"], ["ALB", "2020"]]
+
+
+def test_updated_after_matches_keys_across_dtypes():
+    # Categories of the stored frame and of the delta differ, and so do the TIME_PERIOD types
+    stored = _frame([("AFG", "IM_DTP3", 2020, 61.0), ("ALB", "IM_DTP3", 2020, 95.0)])
+    delta = _frame([("ALB", "IM_DTP3", "2020", 96.0)], categorical=False)
+
+    kept = unchanged_rows(stored, delta, KEY_COLUMNS)
+
+    assert kept["REF_AREA"].astype(str).tolist() == ["AFG"]
+
+
+def test_updated_after_ignores_key_columns_missing_from_a_frame():
+    stored = _frame([("AFG", "IM_DTP3", 2020, 61.0), ("AFG", "IM_DTP3", 2021, 62.0)])
+    delta = _frame([("AFG", "IM_DTP3", 2021, 63.0)])
+
+    kept = unchanged_rows(stored, delta, KEY_COLUMNS + ["SEX"])
+
+    assert kept["TIME_PERIOD"].tolist() == [2020]
+
+
+def test_start_period_drops_the_refetched_window():
+    stored = _frame([
+        ("AFG", "IM_DTP3", 2019, 60.0),
+        ("AFG", "IM_DTP3", 2020, 61.0),
+        ("ALB", "IM_DTP3", 2021, 95.0),
+    ])
+    delta = _frame([("AFG", "IM_DTP3", 2020, 62.0)])
+
+    kept = unchanged_rows(stored, delta, KEY_COLUMNS, start_period="2020")
+
+    assert kept["TIME_PERIOD"].tolist() == [2019]
+
+
+def test_start_period_with_non_yearly_periods():
+    # Monthly periods are parsed as an unordered categorical
+    stored = _frame([
+        ("AFG", "IM_DTP3", "2020-11", 60.0),
+        ("AFG", "IM_DTP3", "2020-12", 61.0),
+        ("AFG", "IM_DTP3", "2021-01", 62.0),
+    ])
+    stored["TIME_PERIOD"] = stored["TIME_PERIOD"].astype("category")
+    delta = _frame([("AFG", "IM_DTP3", "2020-12", 63.0), ("AFG", "IM_DTP3", "2021-01", 64.0)])
+
+    kept = unchanged_rows(stored, delta, KEY_COLUMNS, start_period="2020-12")
+
+    assert kept["TIME_PERIOD"].astype(str).tolist() == ["2020-11"]